@@ -3,19 +3,25 @@ import os
 import numpy as np
 import random
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import pickle
 import datetime
 from tqdm import tqdm
 from recordclass import recordclass
 import math
 import torch
-import torch.autograd as autograd
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import json
+import contextlib
+import hashlib
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 from tensorboardX import SummaryWriter
 
 
@@ -42,48 +48,80 @@ def load_word_embedding(embed_file, vocab):
     custom_print('vocab length:', len(vocab))
     embed_vocab = OrderedDict()
     rev_embed_vocab = OrderedDict()
-    embed_matrix = list()
+    pretrained_matrix = list()
 
     embed_vocab['<PAD>'] = 0
     rev_embed_vocab[0] = '<PAD>'
-    embed_matrix.append(np.zeros(word_embed_dim, dtype=np.float32))
 
     embed_vocab['<UNK>'] = 1
     rev_embed_vocab[1] = '<UNK>'
-    embed_matrix.append(np.random.uniform(-0.25, 0.25, word_embed_dim))
 
     embed_vocab['<SOS>'] = 2
     rev_embed_vocab[2] = '<SOS>'
-    embed_matrix.append(np.random.uniform(-0.25, 0.25, word_embed_dim))
 
     embed_vocab['<EOS>'] = 3
     rev_embed_vocab[3] = '<EOS>'
-    embed_matrix.append(np.random.uniform(-0.25, 0.25, word_embed_dim))
 
     word_idx = 4
     with open(embed_file, "r") as f:
         for line in f:
-            parts = line.split()
-            if len(parts) < word_embed_dim + 1:
+            # only the rows of vocabulary words are parsed
+            parts = line.split(None, 1)
+            if len(parts) < 2:
                 continue
             word = parts[0]
             if word in vocab and vocab[word] >= word_min_freq:
-                vec = [np.float32(val) for val in parts[1:]]
-                embed_matrix.append(vec)
+                vec = np.fromstring(parts[1], dtype=np.float32, sep=' ')
+                if len(vec) < word_embed_dim:
+                    continue
+                pretrained_matrix.append(vec)
                 embed_vocab[word] = word_idx
                 rev_embed_vocab[word_idx] = word
                 word_idx += 1
 
     for word in vocab:
         if word not in embed_vocab and vocab[word] >= word_min_freq:
-            embed_matrix.append(np.random.uniform(-0.25, 0.25, word_embed_dim))
             embed_vocab[word] = word_idx
             rev_embed_vocab[word_idx] = word
             word_idx += 1
 
     custom_print('embed dictionary length:', len(embed_vocab))
 
-    return embed_vocab, rev_embed_vocab, np.array(embed_matrix, dtype=np.float32)
+    return embed_vocab, rev_embed_vocab, np.array(pretrained_matrix, dtype=np.float32).reshape(-1, word_embed_dim)
+
+
+def get_embed_matrix(pretrained_matrix, vocab_size):
+    # <UNK>, <SOS>, <EOS> and the words without a pretrained vector are drawn from the current seed,
+    # in the same order as they are numbered, so only the pretrained rows are cached
+    random_rows = np.random.uniform(-0.25, 0.25, (vocab_size - 1 - len(pretrained_matrix), word_embed_dim))
+    return np.concatenate((np.zeros((1, word_embed_dim)), random_rows[:3], pretrained_matrix,
+                           random_rows[3:])).astype(np.float32)
+
+
+def get_vocab_key(vocab):
+    md5 = hashlib.md5()
+    md5.update(('%d %d\n' % (word_embed_dim, word_min_freq)).encode('utf-8'))
+    for word in vocab:
+        if vocab[word] >= word_min_freq:
+            md5.update((word + '\n').encode('utf-8'))
+    return md5.hexdigest()
+
+
+def load_embedding_cache(cache_folder, embed_file, vocab):
+    meta = load_cache_meta(os.path.join(cache_folder, 'embed_meta.pkl'), [embed_file])
+    if meta is None or meta['version'] != embed_cache_version or meta['vocab_key'] != get_vocab_key(vocab):
+        return None
+    custom_print('loading cached embeddings:', cache_folder)
+    return meta['word_v'], meta['rev_word_v'], np.load(os.path.join(cache_folder, 'embed_pretrained.npy'))
+
+
+def write_embedding_cache(cache_folder, embed_file, vocab, word_v, rev_word_v, pretrained_matrix):
+    meta_file = os.path.join(cache_folder, 'embed_meta.pkl')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    np.save(os.path.join(cache_folder, 'embed_pretrained.npy'), pretrained_matrix)
+    write_cache_meta(meta_file, {'version': embed_cache_version, 'sources': [get_file_signature(embed_file)],
+                                 'vocab_key': get_vocab_key(vocab), 'word_v': word_v, 'rev_word_v': rev_word_v})
 
 
 def build_vocab(data, rels, vocab_file, embed_file):
@@ -111,7 +149,14 @@ def build_vocab(data, rels, vocab_file, embed_file):
 
     vocab[';'] = word_min_freq
     vocab['|'] = word_min_freq
-    word_v, rev_word_v, embed_matrix = load_word_embedding(embed_file, vocab)
+    cache_folder = os.path.dirname(os.path.abspath(vocab_file))
+    cache = load_embedding_cache(cache_folder, embed_file, vocab)
+    if cache is None:
+        word_v, rev_word_v, pretrained_matrix = load_word_embedding(embed_file, vocab)
+        write_embedding_cache(cache_folder, embed_file, vocab, word_v, rev_word_v, pretrained_matrix)
+    else:
+        word_v, rev_word_v, pretrained_matrix = cache
+    embed_matrix = get_embed_matrix(pretrained_matrix, len(word_v))
 
     output = open(vocab_file, 'wb')
     pickle.dump([word_v, char_v], output)
@@ -126,90 +171,342 @@ def load_vocab(vocab_file):
     return word_v, char_v
 
 
-def get_adj_mat(amat):
-    K = 5
-    adj_mat = np.zeros((len(amat), len(amat)), np.float32)
-    for i in range(len(amat)):
-        for j in range(len(amat)):
-            if 0 <= amat[i][j] <= K:
-                adj_mat[i][j] = 1.0 / math.pow(2, amat[i][j])
-            else:
-                adj_mat[i][j] = 0
+def get_adj_edges(amat):
+    dist = np.array(amat, dtype=np.int64).reshape(len(amat), len(amat))
+    rows, cols = np.nonzero((dist >= 0) & (dist <= adj_max_dist))
+    return rows.astype(np.int16), cols.astype(np.int16), dist[rows, cols].astype(np.int8)
+
+
+def get_adj_mat(adj_edges, adj_mat):
+    rows, cols, dists = adj_edges
+    adj_mat[rows, cols] = np.exp2(-dists.astype(np.float32))
     return adj_mat
 
 
-def get_data(src_lines, trg_lines, adj_lines, datatype):
-    samples = []
-    uid = 1
-    src_len = -1
-    trg_len = -1
+def get_batch_adj_edges(cur_samples):
+    # (sample, row, col) triples of all edges in the batch with their exp2(-dist) weights
+    batch_edges = []
+    batch_dists = []
+    for i, sample in enumerate(cur_samples):
+        rows, cols, dists = sample.AdjEdges
+        batch_edges.append(np.stack((np.full(len(rows), i, dtype=np.int64), rows, cols), 1))
+        batch_dists.append(dists)
+    return np.concatenate(batch_edges), np.exp2(-np.concatenate(batch_dists).astype(np.float32))
+
+
+def get_token_ids(words, token_index):
+    return [token_index.setdefault(word, len(token_index)) for word in words]
+
+
+def pack_ragged(seqs, dtype):
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+    values = np.fromiter(itertools.chain.from_iterable(seqs), dtype=dtype, count=int(offsets[-1]))
+    return values, offsets
+
+
+def parse_tuples(trg_line):
+    tup_words = []
+    ent_words = []
+    rel_words = []
+    for tup in trg_line.strip().split('|'):
+        parts = tup.strip().split(";")
+        tup_words.append(tup.split())
+        ent_words.append((parts[0].strip() + " ; " + parts[1].strip()).split())
+        rel_words.append(parts[2].strip().split())
+    return tup_words, ent_words, rel_words
+
+
+def preprocess_lines(src_lines, trg_lines, adj_lines):
+    token_index = OrderedDict()
+    src_seqs = []
+    trg_seqs = []
+    tuple_counts = []
+    tup_seqs = []
+    ent_seqs = []
+    rel_seqs = []
+    adj_rows = []
+    adj_cols = []
+    adj_dists = []
     for i in range(0, len(src_lines)):
         src_line = src_lines[i].strip()
         trg_line = trg_lines[i].strip()
-        src_words = src_line.split()
-        # rel、entity
-
-        tuples = trg_line.strip().split('|')
-        if datatype == 1:
-            random.shuffle(tuples)
-            new_trg_line = ' | '.join(tuples)
-            assert len(trg_line.split()) == len(new_trg_line.split())
-            trg_line = new_trg_line
-
-        rel_line = []
-        for line_i in range(len(tuples)):
-            line_i_rel = tuples[line_i].strip().split(";")
-            rel_line.append(line_i_rel[2].strip())
-        src_rel_line = " | ".join(rel_line)
-
-        entity_line = []
-        for line_i in range(len(tuples)):
-            line_i_entity = tuples[line_i].strip().split(";")
-            entity_line.append(line_i_entity[0].strip() + " ; " + line_i_entity[1].strip())
-        src_entity_line = " | ".join(entity_line)
-
-        entity_words = src_entity_line.strip()
-        src_entity_words = entity_words.split()
-        src_rel_words = src_rel_line.split()
-
-        trg_words = list()
-        trg_words.append('<SOS>')
-        trg_words += trg_line.split()
-        trg_words.append('<EOS>')
+        src_seqs.append(get_token_ids(src_line.split(), token_index))
+        trg_seqs.append(get_token_ids(trg_line.split(), token_index))
 
-        adj_data = json.loads(adj_lines[i])
-        adj_mat = get_adj_mat(adj_data['adj_mat'])
+        tup_words, ent_words, rel_words = parse_tuples(trg_line)
+        tuple_counts.append(len(tup_words))
+        for k in range(len(tup_words)):
+            tup_seqs.append(get_token_ids(tup_words[k], token_index))
+            ent_seqs.append(get_token_ids(ent_words[k], token_index))
+            rel_seqs.append(get_token_ids(rel_words[k], token_index))
 
-        if datatype == 1 and (len(src_words) > max_src_len or len(trg_words) > max_trg_len + 1):
-            continue
-        if len(src_words) > src_len:
-            src_len = len(src_words)
-        if len(trg_words) > trg_len:
-            trg_len = len(trg_words)
-        sample = Sample(Id=uid, SrcLen=len(src_words), SrcWords=src_words, TrgLen=len(trg_words),
-                        TrgWords=trg_words, RelWords= src_rel_words, EntityWords= src_entity_words, AdjMat=adj_mat)
-        samples.append(sample)
-        uid += 1
+        adj_data = json.loads(adj_lines[i])
+        rows, cols, dists = get_adj_edges(adj_data['adj_mat'])
+        adj_rows.append(rows)
+        adj_cols.append(cols)
+        adj_dists.append(dists)
+
+    data_arrays = OrderedDict()
+    data_arrays['src_ids'], data_arrays['src_offsets'] = pack_ragged(src_seqs, np.int32)
+    data_arrays['trg_ids'], data_arrays['trg_offsets'] = pack_ragged(trg_seqs, np.int32)
+    data_arrays['tuple_offsets'] = np.zeros(len(tuple_counts) + 1, dtype=np.int64)
+    np.cumsum(tuple_counts, out=data_arrays['tuple_offsets'][1:])
+    data_arrays['tup_ids'], data_arrays['tup_offsets'] = pack_ragged(tup_seqs, np.int32)
+    data_arrays['ent_ids'], data_arrays['ent_offsets'] = pack_ragged(ent_seqs, np.int32)
+    data_arrays['rel_ids'], data_arrays['rel_offsets'] = pack_ragged(rel_seqs, np.int32)
+    data_arrays['adj_rows'], data_arrays['adj_offsets'] = pack_ragged(adj_rows, np.int16)
+    data_arrays['adj_cols'], _ = pack_ragged(adj_cols, np.int16)
+    data_arrays['adj_dists'], _ = pack_ragged(adj_dists, np.int8)
+    return list(token_index), data_arrays
+
+
+def set_worker_config(max_dist):
+    global adj_max_dist
+    adj_max_dist = max_dist
+
+
+def preprocess_shard(shard):
+    return preprocess_lines(*shard)
+
+
+def concat_offsets(offsets_list):
+    parts = [offsets_list[0]]
+    total = offsets_list[0][-1]
+    for offsets in offsets_list[1:]:
+        parts.append(offsets[1:] + total)
+        total += offsets[-1]
+    return np.concatenate(parts)
+
+
+def merge_preprocessed(results):
+    token_index = OrderedDict()
+    remaps = [np.array(get_token_ids(tokens, token_index), dtype=np.int32) for tokens, _ in results]
+    data_arrays = OrderedDict()
+    for name in results[0][1]:
+        if name.endswith('_offsets'):
+            data_arrays[name] = concat_offsets([arrays[name] for _, arrays in results])
+        elif name.endswith('_ids'):
+            data_arrays[name] = np.concatenate([remap[arrays[name]] for remap, (_, arrays) in zip(remaps, results)])
+        else:
+            data_arrays[name] = np.concatenate([arrays[name] for _, arrays in results])
+    return list(token_index), data_arrays
+
+
+def preprocess_data(src_lines, trg_lines, adj_lines):
+    shards = [(src_lines[i:i + preprocess_shard_size], trg_lines[i:i + preprocess_shard_size],
+               adj_lines[i:i + preprocess_shard_size]) for i in range(0, len(src_lines), preprocess_shard_size)]
+    if num_workers <= 1 or len(shards) <= 1:
+        return preprocess_lines(src_lines, trg_lines, adj_lines)
+    pool = multiprocessing.Pool(min(num_workers, len(shards)), initializer=set_worker_config,
+                                initargs=(adj_max_dist,))
+    try:
+        # map keeps shard order, so the merged token table and Ids match a sequential run
+        results = pool.map(preprocess_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+    return merge_preprocessed(results)
+
+
+def get_ragged_words(tokens, ids, offsets):
+    ids = ids.tolist()
+    offsets = offsets.tolist()
+    return [[tokens[t] for t in ids[offsets[i]:offsets[i + 1]]] for i in range(len(offsets) - 1)]
+
+
+def join_tuple_words(tuple_words, order):
+    words = []
+    for k in range(len(order)):
+        if k > 0:
+            words.append('|')
+        words += tuple_words[order[k]]
+    return words
+
+
+def get_sample(uid, src_words, trg_line_words, tuple_words, adj_edges, datatype):
+    tup_words, ent_words, rel_words = tuple_words
+    tuples = list(range(len(tup_words)))
+    if datatype == 1:
+        # shuffling tuple indices consumes the RNG exactly like shuffling the tuple strings
+        random.shuffle(tuples)
+        trg_line_words = join_tuple_words(tup_words, tuples)
+    src_rel_words = join_tuple_words(rel_words, tuples)
+    src_entity_words = join_tuple_words(ent_words, tuples)
+
+    trg_words = list()
+    trg_words.append('<SOS>')
+    trg_words += trg_line_words
+    trg_words.append('<EOS>')
+
+    if datatype == 1 and (len(src_words) > max_src_len or len(trg_words) > max_trg_len + 1):
+        return None
+    return Sample(Id=uid, SrcLen=len(src_words), SrcWords=src_words, TrgLen=len(trg_words),
+                  TrgWords=trg_words, RelWords=src_rel_words, EntityWords=src_entity_words, AdjEdges=adj_edges,
+                  SrcIds=None, EntityIds=None, RelIds=None, TrgIds=None,
+                  SrcCharIds=None, EntityCharIds=None, RelCharIds=None)
+
+
+def get_data_from_arrays(tokens, data_arrays, datatype):
+    samples = []
+    uid = 1
+    src_seqs = get_ragged_words(tokens, data_arrays['src_ids'], data_arrays['src_offsets'])
+    trg_seqs = get_ragged_words(tokens, data_arrays['trg_ids'], data_arrays['trg_offsets'])
+    tup_seqs = get_ragged_words(tokens, data_arrays['tup_ids'], data_arrays['tup_offsets'])
+    ent_seqs = get_ragged_words(tokens, data_arrays['ent_ids'], data_arrays['ent_offsets'])
+    rel_seqs = get_ragged_words(tokens, data_arrays['rel_ids'], data_arrays['rel_offsets'])
+    tuple_offsets = data_arrays['tuple_offsets'].tolist()
+    adj_offsets = data_arrays['adj_offsets'].tolist()
+    for i in range(0, len(src_seqs)):
+        tuple_slice = slice(tuple_offsets[i], tuple_offsets[i + 1])
+        tuple_words = (tup_seqs[tuple_slice], ent_seqs[tuple_slice], rel_seqs[tuple_slice])
+        adj_edges = tuple(data_arrays[name][adj_offsets[i]:adj_offsets[i + 1]]
+                          for name in ('adj_rows', 'adj_cols', 'adj_dists'))
+        sample = get_sample(uid, src_seqs[i], trg_seqs[i], tuple_words, adj_edges, datatype)
+        if sample is not None:
+            samples.append(sample)
+            uid += 1
     return samples
 
 
-def read_data(src_file, trg_file, adj_file, datatype):
-    reader = open(src_file)
-    src_lines = reader.readlines()
-    reader.close()
+def get_data(src_lines, trg_lines, adj_lines, datatype):
+    tokens, data_arrays = preprocess_data(src_lines, trg_lines, adj_lines)
+    return get_data_from_arrays(tokens, data_arrays, datatype)
+
+
+def get_file_hash(file_name):
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-    reader = open(trg_file)
-    trg_lines = reader.readlines()
-    reader.close()
 
-    reader = open(adj_file)
-    adj_lines = reader.readlines()
+def get_file_signature(file_name):
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': get_file_hash(file_name)}
+
+
+def is_cache_valid(meta, src_files):
+    if len(meta['sources']) != len(src_files):
+        return False
+    for file_name, signature in zip(src_files, meta['sources']):
+        stat = os.stat(file_name)
+        if stat.st_size != signature['size']:
+            return False
+        # an unchanged mtime is trusted, a touched file is only rebuilt if its content changed
+        if stat.st_mtime != signature['mtime']:
+            if get_file_hash(file_name) != signature['hash']:
+                return False
+            signature['mtime'] = stat.st_mtime
+    return True
+
+
+def write_cache_meta(meta_file, meta):
+    output = open(meta_file, 'wb')
+    pickle.dump(meta, output)
+    output.close()
+
+
+def load_cache_meta(meta_file, src_files):
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'rb') as f:
+        meta = pickle.load(f)
+    mtimes = [signature['mtime'] for signature in meta['sources']]
+    if not is_cache_valid(meta, src_files):
+        return None
+    if mtimes != [signature['mtime'] for signature in meta['sources']]:
+        write_cache_meta(meta_file, meta)
+    return meta
+
+
+def write_data_cache(cache_dir, src_files, datatype, tokens, data_arrays):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    meta_file = os.path.join(cache_dir, 'meta.pkl')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    for name in data_arrays:
+        np.save(os.path.join(cache_dir, name + '.npy'), data_arrays[name])
+    # meta is written last so an interrupted build is never mistaken for a valid cache
+    write_cache_meta(meta_file, {'version': data_cache_version, 'sources': [get_file_signature(f) for f in src_files],
+                                 'adj_max_dist': adj_max_dist, 'datatype': datatype,
+                                 'tokens': tokens, 'arrays': list(data_arrays)})
+
+
+def load_data_cache(cache_dir, src_files, datatype):
+    meta = load_cache_meta(os.path.join(cache_dir, 'meta.pkl'), src_files)
+    if meta is None or meta['version'] != data_cache_version:
+        return None
+    # the cached adjacency edges are already filtered by adj_max_dist
+    if meta['adj_max_dist'] != adj_max_dist or meta['datatype'] != datatype:
+        return None
+    data_arrays = OrderedDict()
+    for name in meta['arrays']:
+        data_arrays[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+    return meta['tokens'], data_arrays
+
+
+def read_lines(file_name):
+    reader = open(file_name)
+    lines = reader.readlines()
     reader.close()
+    return lines
 
-    data = get_data(src_lines, trg_lines, adj_lines, datatype)
+
+def read_data(src_file, trg_file, adj_file, datatype):
+    if not use_data_cache:
+        data = get_data(read_lines(src_file), read_lines(trg_file), read_lines(adj_file), datatype)
+        return data
+
+    src_files = [src_file, trg_file, adj_file]
+    cache_dir = os.path.join(data_cache_folder, os.path.splitext(os.path.basename(src_file))[0])
+    cache = load_data_cache(cache_dir, src_files, datatype)
+    if cache is None:
+        custom_print('building data cache:', cache_dir)
+        tokens, data_arrays = preprocess_data(read_lines(src_file), read_lines(trg_file), read_lines(adj_file))
+        write_data_cache(cache_dir, src_files, datatype, tokens, data_arrays)
+        cache = load_data_cache(cache_dir, src_files, datatype)
+    tokens, data_arrays = cache
+    data = get_data_from_arrays(tokens, data_arrays, datatype)
     return data
 
 
+class StreamData(object):
+    """
+    Re-iterable view over a split that reads the three files in lockstep and yields samples lazily
+    """
+    def __init__(self, src_file, trg_file, adj_file, datatype):
+        self.src_file = src_file
+        self.trg_file = trg_file
+        self.adj_file = adj_file  # None skips the dependency file, e.g. for the vocabulary pass
+        self.datatype = datatype
+
+    def __iter__(self):
+        uid = 1
+        src_reader = open(self.src_file)
+        trg_reader = open(self.trg_file)
+        adj_reader = open(self.adj_file) if self.adj_file is not None else None
+        adj_lines = adj_reader if adj_reader is not None else itertools.repeat(None)
+        try:
+            for src_line, trg_line, adj_line in zip(src_reader, trg_reader, adj_lines):
+                trg_line = trg_line.strip()
+                adj_edges = None
+                if adj_line is not None:
+                    adj_edges = get_adj_edges(json.loads(adj_line)['adj_mat'])
+                sample = get_sample(uid, src_line.strip().split(), trg_line.split(), parse_tuples(trg_line),
+                                    adj_edges, self.datatype)
+                if sample is not None:
+                    uid += 1
+                    yield sample
+        finally:
+            src_reader.close()
+            trg_reader.close()
+            if adj_reader is not None:
+                adj_reader.close()
+
+
 def get_relations(file_name):
     rels = []
     reader = open(file_name)
@@ -441,6 +738,71 @@ def shuffle_data(data):
     return new_data
 
 
+def get_padded_tokens(src_len, trg_len, entity_len, rel_len, cur_batch_size):
+    # student source, both teacher-augmented sources and the target are all padded to the batch maximum
+    return cur_batch_size * (3 * src_len + entity_len + rel_len + trg_len)
+
+
+def pack_token_batches(sorted_samples):
+    batches = []
+    cur_batch = []
+    src_len = trg_len = entity_len = rel_len = 0
+    for sample in sorted_samples:
+        new_lens = (max(src_len, sample.SrcLen), max(trg_len, sample.TrgLen),
+                    max(entity_len, len(sample.EntityWords)), max(rel_len, len(sample.RelWords)))
+        # a sample that alone exceeds the budget still gets a batch of its own
+        if len(cur_batch) > 0 and get_padded_tokens(*new_lens, cur_batch_size=len(cur_batch) + 1) > max_batch_tokens:
+            batches.append(cur_batch)
+            cur_batch = []
+            new_lens = (sample.SrcLen, sample.TrgLen, len(sample.EntityWords), len(sample.RelWords))
+        cur_batch.append(sample)
+        src_len, trg_len, entity_len, rel_len = new_lens
+    if len(cur_batch) > 0:
+        batches.append(cur_batch)
+    return batches
+
+
+def get_bucket_batches(buffer):
+    buffer.sort(key=lambda x: (x.SrcLen, x.TrgLen))
+    if max_batch_tokens > 0:
+        batches = pack_token_batches(buffer)
+    else:
+        batches = [buffer[i:i + batch_size] for i in range(0, len(buffer), batch_size)]
+        if len(batches) > 1 and len(batches[-1]) == 1:
+            batches[-2] += batches.pop()
+    random.shuffle(batches)
+    return batches
+
+
+def bucket_batches(samples, buffer_size):
+    buffer = []
+    for sample in samples:
+        buffer.append(sample)
+        if len(buffer) == buffer_size:
+            for batch in get_bucket_batches(buffer):
+                yield batch
+            buffer = []
+    if len(buffer) > 0:
+        for batch in get_bucket_batches(buffer):
+            yield batch
+
+
+def get_batches(samples, cur_batch_size):
+    batch_count = int(math.ceil(len(samples) / cur_batch_size))
+    move_last_batch = False
+    if len(samples) - cur_batch_size * (batch_count - 1) == 1:
+        move_last_batch = True
+        batch_count -= 1
+    batches = []
+    for batch_idx in range(0, batch_count):
+        batch_start = batch_idx * cur_batch_size
+        batch_end = min(len(samples), batch_start + cur_batch_size)
+        if batch_idx == batch_count - 1 and move_last_batch:
+            batch_end = len(samples)
+        batches.append(samples[batch_start:batch_end])
+    return batches
+
+
 def get_max_len(sample_batch):
     src_max_len = len(sample_batch[0].SrcWords)
     for idx in range(1, len(sample_batch)):
@@ -480,19 +842,6 @@ def get_trg_words(cur_trg_idx):
     return cur_trg_words
 
 
-def get_words_index_seq(words, max_len):
-    seq = list()
-    for word in words:
-        if word in word_vocab:
-            seq.append(word_vocab[word])
-        else:
-            seq.append(word_vocab['<UNK>'])
-    pad_len = max_len - len(words)
-    for i in range(0, pad_len):
-        seq.append(word_vocab['<PAD>'])
-    return seq
-
-
 def get_target_words_index_seq(words, max_len):
     seq = list()
     for word in words:
@@ -506,31 +855,29 @@ def get_target_words_index_seq(words, max_len):
     return seq
 
 
-def get_padded_mask(cur_len, max_len):
-    mask_seq = list()
-    for i in range(0, cur_len):
-        mask_seq.append(0)
-    pad_len = max_len - cur_len
-    for i in range(0, pad_len):
-        mask_seq.append(1)
-    return mask_seq
+def get_word_ids(words):
+    unk_id = word_vocab['<UNK>']
+    return np.array([word_vocab.get(word, unk_id) for word in words], dtype=np.int64)
 
 
-def get_target_vocab_mask(src_words):
-    mask = []
-    for i in range(0, len(word_vocab)):
-        mask.append(1)
-    for word in src_words:
-        if word in word_vocab:
-            mask[word_vocab[word]] = 0
-    for rel in relations:
-        mask[word_vocab[rel]] = 0
+def encode_sample(sample):
+    sample.SrcIds = get_word_ids(sample.SrcWords)
+    sample.EntityIds = get_word_ids(sample.EntityWords)
+    sample.RelIds = get_word_ids(sample.RelWords)
+    sample.TrgIds = get_word_ids(sample.TrgWords)
+    sample.SrcCharIds = char_table.get_ids(sample.SrcWords)
+    sample.EntityCharIds = char_table.get_ids(sample.EntityWords)
+    sample.RelCharIds = char_table.get_ids(sample.RelWords)
 
-    mask[word_vocab['<UNK>']] = 0
-    mask[word_vocab['<EOS>']] = 0
-    mask[word_vocab[';']] = 0
-    mask[word_vocab['|']] = 0
-    return mask
+
+def get_padded_mask(lens, max_len):
+    return (np.arange(max_len)[None, :] >= np.array(lens)[:, None]).astype(np.uint8)
+
+
+def get_vocab_const_ids():
+    const_ids = [word_vocab[rel] for rel in relations]
+    const_ids += [word_vocab['<UNK>'], word_vocab['<EOS>'], word_vocab[';'], word_vocab['|']]
+    return np.array(const_ids, dtype=np.int64)
 
 
 def get_rel_mask(trg_words, max_len):
@@ -547,99 +894,205 @@ def get_rel_mask(trg_words, max_len):
     return mask_seq
 
 
-def get_char_seq(words, max_len):
-    char_seq = list()
-    for i in range(0, conv_filter_size - 1):
-        char_seq.append(char_vocab['<PAD>'])
-    for word in words:
-        for c in word[0:min(len(word), max_word_len)]:
-            if c in char_vocab:
-                char_seq.append(char_vocab[c])
-            else:
-                char_seq.append(char_vocab['<UNK>'])
-        pad_len = max_word_len - len(word)
-        for i in range(0, pad_len):
-            char_seq.append(char_vocab['<PAD>'])
-        for i in range(0, conv_filter_size - 1):
-            char_seq.append(char_vocab['<PAD>'])
+def get_word_chars(word):
+    unk_id = char_vocab['<UNK>']
+    return [char_vocab.get(c, unk_id) for c in word[0:min(len(word), max_word_len)]]
 
-    pad_len = max_len - len(words)
-    for i in range(0, pad_len):
-        for i in range(0, max_word_len + conv_filter_size - 1):
-            char_seq.append(char_vocab['<PAD>'])
-    return char_seq
+
+class CharTable(object):
+    """
+    Padded character ids of every distinct word, built once and gathered by row id for each batch
+    """
+    def __init__(self, words):
+        # row 0 stays all <PAD> and is used for padding positions
+        self.table = np.full((len(words) + 1, max_word_len), char_vocab['<PAD>'], dtype=np.int64)
+        self.index = dict()
+        self.size = 1
+        self.lock = threading.Lock()
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        with self.lock:
+            # batches may be encoded concurrently by the prefetch workers
+            if word not in self.index:
+                self.add_row(word)
+        return self.index[word]
+
+    def add_row(self, word):
+        if self.size == len(self.table):
+            self.table = np.concatenate((self.table, np.full_like(self.table, char_vocab['<PAD>'])))
+        chars = get_word_chars(word)
+        self.table[self.size, :len(chars)] = chars
+        self.index[word] = self.size
+        self.size += 1
+
+    def get_ids(self, words):
+        return np.array([self.index[word] if word in self.index else self.add(word) for word in words],
+                        dtype=np.int64)
+
+    def get_char_seq(self, char_word_ids):
+        # [batch, max_len, max_word_len], one row of character ids per word
+        return self.table[char_word_ids]
 
 
 def get_batch_data(cur_samples, is_training=False):
     """
     Returns the training samples and labels as numpy array
     """
-    batch_src_max_len, batch_trg_max_len, batch_rel_max_len, batch_entity_max_len = get_max_len(cur_samples)  # SrcLen，TrgLen
-    src_words_list = list()
-    src_words_mask_list = list()
-    src_char_seq = list()
-    # tea1
-    src_tea1_words_list = list()
-    src_tea1_words_mask_list = list()
-    src_tea1_char_seq = list()
-    # tea2
-    src_tea2_words_list = list()
-    src_tea2_words_mask_list = list()
-    src_tea2_char_seq = list()
-
-    trg_words_list = list()
-    trg_stu_vocab_mask = list()
-    trg_tea1_vocab_mask = list()
-    trg_tea2_vocab_mask = list()
-    adj_lst = []
-
-    target = list()
-    cnt = 0
     for sample in cur_samples:
-        src_words_list.append(get_words_index_seq(sample.SrcWords, batch_src_max_len))
-        src_words_mask_list.append(get_padded_mask(sample.SrcLen, batch_src_max_len))
-        src_char_seq.append(get_char_seq(sample.SrcWords, batch_src_max_len))
-
-        tea1Words = sample.SrcWords+sample.EntityWords
-        tea2Words = sample.SrcWords+sample.RelWords
-        src_tea1_words_list.append(get_words_index_seq(tea1Words, batch_src_max_len+batch_entity_max_len))
-        src_tea1_words_mask_list.append(get_padded_mask(len(tea1Words), batch_src_max_len+batch_entity_max_len))
-        src_tea2_words_list.append(get_words_index_seq(tea2Words, batch_src_max_len+batch_rel_max_len))
-        src_tea2_words_mask_list.append(get_padded_mask(len(tea2Words),  batch_src_max_len+batch_rel_max_len))
-        src_tea1_char_seq.append(get_char_seq(tea1Words, batch_src_max_len + batch_entity_max_len))  # entity
-        src_tea2_char_seq.append(get_char_seq(tea2Words, batch_src_max_len + batch_rel_max_len))  # rel
-        #
-        trg_stu_vocab_mask.append(get_target_vocab_mask(sample.SrcWords))
-        trg_tea1_vocab_mask.append(get_target_vocab_mask(tea1Words))
-        trg_tea2_vocab_mask.append(get_target_vocab_mask(tea2Words))
-
-        cur_masked_adj = np.zeros((batch_src_max_len, batch_src_max_len), dtype=np.float32)
-        cur_masked_adj[:len(sample.SrcWords), :len(sample.SrcWords)] = sample.AdjMat
-        adj_lst.append(cur_masked_adj)
-
+        if sample.SrcIds is None:
+            encode_sample(sample)
+    batch_src_max_len, batch_trg_max_len, batch_rel_max_len, batch_entity_max_len = get_max_len(cur_samples)  # SrcLen，TrgLen
+    batch_len = len(cur_samples)
+    tea1_max_len = batch_src_max_len + batch_entity_max_len
+    tea2_max_len = batch_src_max_len + batch_rel_max_len
+    pad_id = word_vocab['<PAD>']
+
+    src_words = np.full((batch_len, batch_src_max_len), pad_id, dtype=np.int64)
+    src_tea1_words = np.full((batch_len, tea1_max_len), pad_id, dtype=np.int64)
+    src_tea2_words = np.full((batch_len, tea2_max_len), pad_id, dtype=np.int64)
+    src_char_words = np.zeros((batch_len, batch_src_max_len), dtype=np.int64)
+    src_tea1_char_words = np.zeros((batch_len, tea1_max_len), dtype=np.int64)
+    src_tea2_char_words = np.zeros((batch_len, tea2_max_len), dtype=np.int64)
+    # the dense adjacency is n^2 per sample, the sparse GCN only needs the edges
+    use_adj_edges = sparse_gcn and n_gpu <= 1
+    if not use_adj_edges:
+        adj = np.zeros((batch_len, batch_src_max_len, batch_src_max_len), dtype=np.float32)
+    if is_training:
+        trg_words = np.full((batch_len, batch_trg_max_len), pad_id, dtype=np.int64)
+    else:
+        trg_words = np.full((batch_len, 1), word_vocab['<SOS>'], dtype=np.int64)
+
+    for i, sample in enumerate(cur_samples):
+        src_len = len(sample.SrcIds)
+        src_words[i, :src_len] = sample.SrcIds
+        src_tea1_words[i, :src_len] = sample.SrcIds
+        src_tea1_words[i, src_len:src_len + len(sample.EntityIds)] = sample.EntityIds
+        src_tea2_words[i, :src_len] = sample.SrcIds
+        src_tea2_words[i, src_len:src_len + len(sample.RelIds)] = sample.RelIds
+        src_char_words[i, :src_len] = sample.SrcCharIds
+        src_tea1_char_words[i, :src_len] = sample.SrcCharIds
+        src_tea1_char_words[i, src_len:src_len + len(sample.EntityCharIds)] = sample.EntityCharIds
+        src_tea2_char_words[i, :src_len] = sample.SrcCharIds
+        src_tea2_char_words[i, src_len:src_len + len(sample.RelCharIds)] = sample.RelCharIds
+        if not use_adj_edges:
+            get_adj_mat(sample.AdjEdges, adj[i])
         if is_training:
-            padded_trg_words = get_words_index_seq(sample.TrgWords, batch_trg_max_len)
-            trg_words_list.append(padded_trg_words)
-            target.append(padded_trg_words[1:])
+            trg_words[i, :len(sample.TrgIds)] = sample.TrgIds
+
+    src_lens = [len(sample.SrcIds) for sample in cur_samples]
+    src_words_mask = get_padded_mask(src_lens, batch_src_max_len)
+    src_tea1_words_mask = get_padded_mask([n + len(sample.EntityIds) for n, sample in zip(src_lens, cur_samples)],
+                                          tea1_max_len)
+    src_tea2_words_mask = get_padded_mask([n + len(sample.RelIds) for n, sample in zip(src_lens, cur_samples)],
+                                          tea2_max_len)
+    # allowed target ids are the source words, padded with the always allowed <UNK>
+    unk_id = word_vocab['<UNK>']
+    batch_data = {'src_words': src_words,
+            'src_words_mask': src_words_mask,
+            'src_chars': char_table.get_char_seq(src_char_words),
+            'src_char_ids': src_char_words,
+            'src_tea1_words': src_tea1_words,
+            'src_tea1_words_mask': src_tea1_words_mask,
+            'src_tea1_chars': char_table.get_char_seq(src_tea1_char_words),
+            'src_tea1_char_ids': src_tea1_char_words,
+            'src_tea2_words': src_tea2_words,
+            'src_tea2_words_mask': src_tea2_words_mask,
+            'src_tea2_chars': char_table.get_char_seq(src_tea2_char_words),
+            'src_tea2_char_ids': src_tea2_char_words,
+            'trg_stu_vocab_ids': np.where(src_words_mask, unk_id, src_words),
+            'trg_tea1_vocab_ids': np.where(src_tea1_words_mask, unk_id, src_tea1_words),
+            'trg_tea2_vocab_ids': np.where(src_tea2_words_mask, unk_id, src_tea2_words),
+            'trg_words': trg_words,
+            'target': trg_words[:, 1:] if is_training else np.array([])}
+    if use_adj_edges:
+        batch_data['adj_edges'], batch_data['adj_weights'] = get_batch_adj_edges(cur_samples)
+    else:
+        batch_data['adj'] = adj
+    if is_training and candidate_softmax:
+        # the candidates cover what any of the three models may emit plus the targets, <PAD> sorts first
+        # so the remapped padding keeps id 0 for NLLLoss(ignore_index=0)
+        trg_cand_ids = np.unique(np.concatenate((vocab_const_ids, [pad_id], src_tea1_words.ravel(),
+                                                 src_tea2_words.ravel(), trg_words.ravel())))
+        batch_data['trg_cand_ids'] = trg_cand_ids
+        batch_data['target'] = np.searchsorted(trg_cand_ids, trg_words[:, 1:])
+    return batch_data
+
+
+def get_batch_tensors(cur_samples_input):
+    batch_tensors = dict()
+    for name in cur_samples_input:
+        if name.endswith('_mask'):
+            tensor = torch.from_numpy(cur_samples_input[name].astype('uint8'))
+        elif name in ('adj', 'adj_weights'):
+            tensor = torch.from_numpy(cur_samples_input[name].astype('float32'))
         else:
-            trg_words_list.append(get_words_index_seq(['<SOS>'], 1))
-        cnt += 1
-
-    return {'src_words': np.array(src_words_list, dtype=np.float32),
-            'src_words_mask': np.array(src_words_mask_list),
-            'src_chars': np.array(src_char_seq),
-            'src_tea1_words': np.array(src_tea1_words_list),
-            'src_tea1_words_mask': np.array(src_tea1_words_mask_list),
-            'src_tea1_chars': np.array(src_tea1_char_seq),
-            'src_tea2_words': np.array(src_tea2_words_list),
-            'src_tea2_words_mask': np.array(src_tea2_words_mask_list),
-            'src_tea2_chars': np.array(src_tea2_char_seq),
-            'adj': np.array(adj_lst),
-            'trg_stu_vocab_mask': np.array(trg_stu_vocab_mask),
-            'trg_tea1_vocab_mask': np.array(trg_tea1_vocab_mask),
-            'trg_tea2_vocab_mask': np.array(trg_tea2_vocab_mask),
-            'trg_words': np.array(trg_words_list, dtype=np.int32),
-            'target': np.array(target)}
+            tensor = torch.from_numpy(cur_samples_input[name].astype('long'))
+        if device.type == 'cuda':
+            tensor = tensor.pin_memory()
+        batch_tensors[name] = tensor
+    return batch_tensors
+
+
+def collate_batch(cur_batch, is_training):
+    return get_batch_tensors(get_batch_data(cur_batch, is_training))
+
+
+def get_model_inputs(batch_tensors, model_name):
+    src_name = {'stu': 'src', 'tea1': 'src_tea1', 'tea2': 'src_tea2'}[model_name]
+    if 'adj' in batch_tensors:
+        adj = batch_tensors['adj']
+    else:
+        adj = (batch_tensors['adj_edges'], batch_tensors['adj_weights'])
+    chars = (batch_tensors[src_name + '_chars'], batch_tensors[src_name + '_char_ids'])
+    return (batch_tensors[src_name + '_words'], chars, batch_tensors[src_name + '_words_mask'],
+            batch_tensors['trg_words'], batch_tensors['trg_' + model_name + '_vocab_ids'], adj)
+
+
+class BatchPrefetcher(object):
+    """
+    Collates upcoming batches on worker threads while the current one runs on the device
+    """
+    def __init__(self, batches, is_training):
+        self.batches = batches
+        self.is_training = is_training
+        self.stall_time = 0.0
+
+    def to_device(self, batch_tensors):
+        if device.type != 'cpu':
+            for name in batch_tensors:
+                batch_tensors[name] = batch_tensors[name].to(device, non_blocking=True)
+        return batch_tensors
+
+    def wait(self, cur_batch, future):
+        start_time = time.time()
+        batch_tensors = future.result()
+        self.stall_time += time.time() - start_time
+        return cur_batch, self.to_device(batch_tensors)
+
+    def __iter__(self):
+        if prefetch_workers == 0:
+            for cur_batch in self.batches:
+                start_time = time.time()
+                batch_tensors = collate_batch(cur_batch, self.is_training)
+                self.stall_time += time.time() - start_time
+                yield cur_batch, self.to_device(batch_tensors)
+            return
+        executor = ThreadPoolExecutor(prefetch_workers)
+        pending = deque()
+        try:
+            # at most prefetch_depth batches are in flight, results are consumed in submission order
+            for cur_batch in self.batches:
+                pending.append((cur_batch, executor.submit(collate_batch, cur_batch, self.is_training)))
+                if len(pending) > prefetch_depth:
+                    yield self.wait(*pending.popleft())
+            while len(pending) > 0:
+                yield self.wait(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown()
 
 
 class WordEmbeddings(nn.Module):
@@ -681,16 +1134,38 @@ class GCN(nn.Module):
         self.dropout = nn.Dropout(self.drop_rate)
 
     def forward(self, gcn_input, adj):
+        if isinstance(adj, tuple):
+            return self.forward_edges(gcn_input, *adj)
+        # the adjacency only covers the source words, the entity/relation words of the teachers have no edges
+        pad_len = gcn_input.size(1) - adj.size(1)
+        if pad_len > 0:
+            adj = F.pad(adj, (0, pad_len, 0, pad_len))
         denom = torch.sum(adj, 2).unsqueeze(2) + 1
         for i in range(self.gcn_num_layers):
             Ax = torch.bmm(adj, gcn_input)
-            AxW = self.gcn_layers[i](Ax)
-            AxW = AxW + self.gcn_layers[i](gcn_input)
+            # W(Ax) + b + W(x) + b in a single linear
+            AxW = self.gcn_layers[i](Ax + gcn_input) + self.gcn_layers[i].bias
             AxW /= denom
             gAxW = F.relu(AxW)
             gcn_input = self.dropout(gAxW) if i < self.gcn_num_layers - 1 else gAxW
         return gcn_input
 
+    def forward_edges(self, gcn_input, adj_edges, adj_weights):
+        # same as forward on an edge list, so the cost grows with the edges instead of n^2
+        batch_len, seq_len, dim = gcn_input.size()
+        dst = adj_edges[:, 0] * seq_len + adj_edges[:, 1]
+        src = adj_edges[:, 0] * seq_len + adj_edges[:, 2]
+        adj_weights = adj_weights.type_as(gcn_input)
+        denom = gcn_input.new_ones(batch_len * seq_len).index_add_(0, dst, adj_weights).view(batch_len, seq_len, 1)
+        for i in range(self.gcn_num_layers):
+            x = gcn_input.reshape(-1, dim)
+            Ax = torch.zeros_like(x).index_add_(0, dst, x.index_select(0, src) * adj_weights.unsqueeze(1))
+            AxW = self.gcn_layers[i](Ax.view(batch_len, seq_len, dim) + gcn_input) + self.gcn_layers[i].bias
+            AxW = AxW / denom
+            gAxW = F.relu(AxW)
+            gcn_input = self.dropout(gAxW) if i < self.gcn_num_layers - 1 else gAxW
+        return gcn_input
+
 
 class Encoder(nn.Module):
     def __init__(self, input_dim, hidden_dim, layers, is_bidirectional, drop_out_rate):
@@ -712,26 +1187,73 @@ class Encoder(nn.Module):
                                 bidirectional=self.is_bidirectional)
             self.gcn = GCN(gcn_num_layers, 2 * self.hidden_dim, 2 * self.hidden_dim)
         self.dropout = nn.Dropout(self.drop_rate)
-        self.conv1d = nn.Conv1d(char_embed_dim, char_feature_size, conv_filter_size)
-        self.max_pool = nn.MaxPool1d(max_word_len + conv_filter_size - 1, max_word_len + conv_filter_size - 1)
-
-    def forward(self, words_input, char_seq, adj, is_training=False):
-        char_embeds = self.char_embeddings(char_seq)
+        # the padding stands in for the <PAD> gap that used to separate the words of the flat character stream
+        self.conv1d = nn.Conv1d(char_embed_dim, char_feature_size, conv_filter_size, padding=conv_filter_size - 1)
+        self.char_cache = None
+        self.char_cached = None
+
+    def train(self, mode=True):
+        # the cached char features are only valid for the weights they were computed with
+        self.char_cache = None
+        self.char_cached = None
+        return super(Encoder, self).train(mode)
+
+    def get_char_features(self, chars):
+        char_embeds = self.char_embeddings(chars)
         char_embeds = char_embeds.permute(0, 2, 1)
+        return torch.tanh(torch.max(self.conv1d(char_embeds), 2)[0])
+
+    def get_cached_char_features(self, chars, char_word_ids):
+        # char features by CharTable row id, computed once per word while the model is in eval mode
+        word_ids, inverse = torch.unique(char_word_ids, sorted=True, return_inverse=True)
+        num_ids = int(word_ids[-1]) + 1
+        if self.char_cache is None or self.char_cache.size(0) < num_ids:
+            cache_size = num_ids if self.char_cache is None else max(num_ids, 2 * self.char_cache.size(0))
+            char_cache = chars.new_zeros((cache_size, char_feature_size), dtype=torch.float32)
+            char_cached = chars.new_zeros(cache_size, dtype=torch.uint8)
+            if self.char_cache is not None:
+                char_cache[:self.char_cache.size(0)] = self.char_cache
+                char_cached[:self.char_cached.size(0)] = self.char_cached
+            self.char_cache = char_cache
+            self.char_cached = char_cached
+        missing = self.char_cached[word_ids].eq(0)
+        if missing.any():
+            word_chars = chars.new_zeros((word_ids.size(0), chars.size(1))).index_copy_(0, inverse, chars)
+            missing_ids = word_ids[missing]
+            self.char_cache[missing_ids] = self.get_char_features(word_chars[missing]).detach().float()
+            self.char_cached[missing_ids] = 1
+        return self.char_cache[char_word_ids]
+
+    def run_lstm(self, words_input, src_mask):
+        if not pack_encoder:
+            outputs, hc = self.lstm(words_input)
+            return outputs
+        # packing skips the padding, so the backward direction starts at the last real word
+        src_lens = src_mask.eq(0).long().sum(dim=1).cpu()
+        packed_input = nn.utils.rnn.pack_padded_sequence(words_input, src_lens, batch_first=True, enforce_sorted=False)
+        outputs, hc = self.lstm(packed_input)
+        outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True, total_length=words_input.size(1))
+        return outputs
 
-        char_feature = torch.tanh(self.max_pool(self.conv1d(char_embeds)))
-        char_feature = char_feature.permute(0, 2, 1)
+    def forward(self, words_input, char_seq, adj, src_mask, is_training=False):
+        chars, char_word_ids = char_seq
+        batch_len, max_len, word_len = chars.size()
+        if cache_char_features and not self.training and n_gpu <= 1:
+            char_feature = self.get_cached_char_features(chars.view(-1, word_len), char_word_ids.view(-1))
+        else:
+            char_feature = self.get_char_features(chars.view(-1, word_len))
+        char_feature = char_feature.view(batch_len, max_len, -1)
 
         words_input = torch.cat((words_input, char_feature), -1)
         if enc_type == 'LSTM':
-            outputs, hc = self.lstm(words_input)
+            outputs = self.run_lstm(words_input, src_mask)
             outputs = self.dropout(outputs)
         elif enc_type == 'GCN':
             outputs = self.reduce_dim(words_input)
             outputs = self.gcn(outputs, adj)
             outputs = self.dropout(outputs)
         else:
-            outputs, hc = self.lstm(words_input)
+            outputs = self.run_lstm(words_input, src_mask)
             outputs = self.dropout(outputs)
             outputs = self.gcn(outputs, adj)
             outputs = self.dropout(outputs)
@@ -754,15 +1276,18 @@ class Attention(nn.Module):
         self.linear_query = nn.Linear(self.input_dim, self.input_dim, bias=True)
         self.v = nn.Linear(self.input_dim, 1)
 
-    def forward(self, s_prev, enc_hs, src_mask):
-        uh = self.linear_ctx(enc_hs)
-        wq = self.linear_query(s_prev)
+    def forward(self, s_prev, enc_hs, src_mask, uh=None):
+        # uh only depends on the encoder, so the decoder passes it in precomputed
+        if uh is None:
+            uh = self.linear_ctx(enc_hs)
+        wq = self.linear_query(s_prev).unsqueeze(1)
         wquh = torch.tanh(wq + uh)
-        attn_weights = self.v(wquh).squeeze()
+        # scores are masked and normalized in float32, so reduced precision runs stay safe with -inf
+        attn_weights = self.v(wquh).squeeze(2).float()
         attn_weights.data.masked_fill_(src_mask.data, -float('inf'))
 
         attn_weights = F.softmax(attn_weights, dim=-1)
-        ctx = torch.bmm(attn_weights.unsqueeze(1), enc_hs).squeeze()
+        ctx = torch.bmm(attn_weights.type_as(enc_hs).unsqueeze(1), enc_hs).squeeze(1)
         return ctx, attn_weights
 
 
@@ -778,23 +1303,42 @@ class NGram_Attention(nn.Module):
             self.W_layers.append(nn.Linear(input_dim, input_dim))
 
     def forward(self, s_prev, enc_hs, src_mask):
-        att = torch.bmm(s_prev.unsqueeze(1), self.V_layers[0](enc_hs).transpose(1, 2)).squeeze()
+        att = torch.bmm(s_prev.unsqueeze(1), self.V_layers[0](enc_hs).transpose(1, 2)).squeeze(1).float()
         att.data.masked_fill_(src_mask.data, -float('inf'))
         att = F.softmax(att, dim=-1)
-        ctx = self.W_layers[0](torch.bmm(att.unsqueeze(1), enc_hs).squeeze())
+        ctx = self.W_layers[0](torch.bmm(att.type_as(enc_hs).unsqueeze(1), enc_hs).squeeze(1))
         for i in range(1, self.layers):
             enc_hs_ngram = torch.nn.AvgPool1d(i+1, 1)(enc_hs.transpose(1, 2)).transpose(1, 2)
             n_mask = src_mask.unsqueeze(1).float()
-            n_mask = torch.nn.AvgPool1d(i+1, 1)(n_mask).squeeze()
+            n_mask = torch.nn.AvgPool1d(i+1, 1)(n_mask).squeeze(1)
             n_mask[n_mask > 0] = 1
             n_mask = n_mask.byte()
-            n_att = torch.bmm(s_prev.unsqueeze(1), self.V_layers[i](enc_hs_ngram).transpose(1, 2)).squeeze()
+            n_att = torch.bmm(s_prev.unsqueeze(1), self.V_layers[i](enc_hs_ngram).transpose(1, 2)).squeeze(1).float()
             n_att.data.masked_fill_(n_mask.data, -float('inf'))
             n_att = F.softmax(n_att, dim=-1)
-            ctx += self.W_layers[i](torch.bmm(n_att.unsqueeze(1), enc_hs_ngram).squeeze())
+            ctx += self.W_layers[i](torch.bmm(n_att.type_as(enc_hs).unsqueeze(1), enc_hs_ngram).squeeze(1))
         return ctx, att
 
 
+def unigram_decoder_steps(y_gates, h, c, enc_hs, uh, src_mask, w_query, b_query, w_v, b_v, w_ctx, w_hh,
+                          drop_out_rate, is_training):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, float, bool) -> Tensor
+    # teacher-forced Unigram attention + LSTMCell recurrence, y_gates holds the precomputed input projection of y
+    hiddens = torch.jit.annotate(List[torch.Tensor], [])
+    for t in range(y_gates.size(1)):
+        wq = (torch.matmul(h, w_query.t()) + b_query).unsqueeze(1)
+        attn_weights = (torch.matmul(torch.tanh(wq + uh), w_v.t()) + b_v).squeeze(2)
+        attn_weights = torch.softmax(attn_weights.masked_fill(src_mask, -float('inf')), -1)
+        ctx = torch.bmm(attn_weights.unsqueeze(1), enc_hs).squeeze(1)
+        gates = y_gates[:, t] + torch.matmul(ctx, w_ctx.t()) + torch.matmul(h, w_hh.t())
+        in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+        c = torch.sigmoid(forget_gate) * c + torch.sigmoid(in_gate) * torch.tanh(cell_gate)
+        h = torch.sigmoid(out_gate) * torch.tanh(c)
+        h = torch.dropout(h, drop_out_rate, is_training)
+        hiddens.append(h)
+    return torch.stack(hiddens, 1)
+
+
 class Decoder(nn.Module):
     def __init__(self, input_dim, hidden_dim, layers, drop_out_rate, max_length):
         super(Decoder, self).__init__()
@@ -814,30 +1358,55 @@ class Decoder(nn.Module):
 
         self.dropout = nn.Dropout(self.drop_rate)
         self.ent_out = nn.Linear(self.input_dim, len(word_vocab))
+        self.scripted_steps = None
+        if script_decoder and att_type == 'Unigram':
+            self.scripted_steps = torch.jit.script(unigram_decoder_steps)
 
-    def forward(self, y_prev, h_prev, enc_hs, src_word_embeds, src_mask, is_training=False):
-        src_time_steps = enc_hs.size()[1]
+    def init_cache(self, enc_hs, src_word_embeds, src_mask):
+        """Computes the step-invariant parts of the decoder input once per batch.
+
+        The cache is a tuple of [batch, ...] tensors: the attention context projection for Unigram,
+        the (context, attention weights) pair otherwise, as these do not depend on the decoder state.
+        """
         if att_type == 'None':
             ctx = mean_over_time(enc_hs, src_mask)  # ctx == context
-            attn_weights = torch.zeros(src_mask.size()).cuda()
+            return ctx, enc_hs.new_zeros(src_mask.size())
         elif att_type == 'Unigram':
-            s_prev = h_prev[0]
-            s_prev = s_prev.unsqueeze(1)
-            s_prev = s_prev.repeat(1, src_time_steps, 1)
-            ctx, attn_weights = self.attention(s_prev, enc_hs, src_mask)
+            return self.attention.linear_ctx(enc_hs),
         else:
             last_index = src_mask.size()[1] - torch.sum(src_mask, dim=-1).long() - 1
             last_index = last_index.unsqueeze(1).unsqueeze(1).repeat(1, 1, enc_hs.size()[-1])
-            enc_last = torch.gather(enc_hs, 1, last_index).squeeze()
+            enc_last = torch.gather(enc_hs, 1, last_index).squeeze(1)
             ctx, attn_weights = self.attention(enc_last, src_word_embeds, src_mask)
-            ctx = torch.cat((enc_last, ctx), -1)
+            return torch.cat((enc_last, ctx), -1), attn_weights
+
+    def step(self, y_prev, h_prev, enc_hs, src_mask, dec_cache):
+        if att_type == 'Unigram':
+            ctx, attn_weights = self.attention(h_prev[0], enc_hs, src_mask, dec_cache[0])
+        else:
+            ctx, attn_weights = dec_cache
 
-        y_prev = y_prev.squeeze()
+        y_prev = y_prev.view(-1, self.input_dim)
         s_cur = torch.cat((y_prev, ctx), 1)
         hidden, cell_state = self.lstm(s_cur, h_prev)
         hidden = self.dropout(hidden)
-        output = self.ent_out(hidden)
-        return output, (hidden, cell_state), attn_weights
+        return (hidden, cell_state), attn_weights
+
+    def run_steps(self, y_seq, h_prev, enc_hs, src_mask, dec_cache):
+        """Teacher-forced recurrence over y_seq [batch, steps, dim], returns the hidden states of all steps."""
+        if self.scripted_steps is not None and train_dtype == 'float32':
+            w_ih = self.lstm.weight_ih
+            y_gates = F.linear(y_seq, w_ih[:, :self.input_dim], self.lstm.bias_ih + self.lstm.bias_hh)
+            attention = self.attention
+            return self.scripted_steps(y_gates, h_prev[0], h_prev[1], enc_hs, dec_cache[0], src_mask,
+                                       attention.linear_query.weight, attention.linear_query.bias,
+                                       attention.v.weight, attention.v.bias, w_ih[:, self.input_dim:],
+                                       self.lstm.weight_hh, self.drop_rate, self.training)
+        hiddens = []
+        for t in range(y_seq.size()[1]):
+            h_prev, attn_weights = self.step(y_seq[:, t, :], h_prev, enc_hs, src_mask, dec_cache)
+            hiddens.append(h_prev[0])
+        return torch.stack(hiddens, 1)
 
 
 class SeqToSeqModel(nn.Module):
@@ -846,8 +1415,131 @@ class SeqToSeqModel(nn.Module):
         self.word_embeddings = WordEmbeddings(len(word_vocab), word_embed_dim, word_embed_matrix, drop_rate)
         self.encoder = Encoder(enc_inp_size, int(enc_hidden_size/2), layers, True, drop_rate)
         self.decoder = Decoder(dec_inp_size, dec_hidden_size, layers, drop_rate, max_trg_len)
-
-    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, is_training=False):
+        self.trg_vocab_base_mask = None
+        self.trg_const_ids = None
+
+    def get_trg_vocab_mask(self, trg_vocab_ids):
+        # the relations and separators are always allowed, so that part of the mask is built once per device
+        if self.trg_vocab_base_mask is None or self.trg_vocab_base_mask.device != trg_vocab_ids.device:
+            base_mask = torch.ones(len(word_vocab), dtype=torch.uint8)
+            base_mask[torch.from_numpy(vocab_const_ids)] = 0
+            self.trg_vocab_base_mask = base_mask.to(trg_vocab_ids.device)
+        trg_vocab_mask = self.trg_vocab_base_mask.unsqueeze(0).repeat(trg_vocab_ids.size(0), 1)
+        return trg_vocab_mask.scatter_(1, trg_vocab_ids, 0)
+
+    def get_trg_cands(self, trg_vocab_ids):
+        """Sorted allowed ids of every row with repeats flagged, and the matching rows of ent_out"""
+        if self.trg_const_ids is None or self.trg_const_ids.device != trg_vocab_ids.device:
+            self.trg_const_ids = torch.from_numpy(vocab_const_ids).to(trg_vocab_ids.device)
+        batch_len = trg_vocab_ids.size(0)
+        cand_ids = torch.cat((self.trg_const_ids.unsqueeze(0).expand(batch_len, -1), trg_vocab_ids), 1)
+        cand_ids, _ = cand_ids.sort(dim=1)
+        # repeated ids (source words seen twice, <UNK> padding) would count twice in the softmax
+        prev_ids = torch.cat((cand_ids[:, :1] - 1, cand_ids[:, :-1]), 1)
+        cand_dup = cand_ids.eq(prev_ids)
+        cand_weight = self.decoder.ent_out.weight.index_select(0, cand_ids.view(-1)).view(batch_len, cand_ids.size(1), -1)
+        cand_bias = self.decoder.ent_out.bias.index_select(0, cand_ids.view(-1)).view(batch_len, -1)
+        return cand_ids, cand_dup, cand_weight, cand_bias
+
+    def get_step_log_probs(self, hidden, trg_vocab_mask, trg_cands):
+        # log-probs over the vocabulary, or over the candidate columns of every row with trg_cands
+        if trg_cands is None:
+            cur_dec_out = self.decoder.ent_out(hidden).float()
+            if trg_vocab_mask is not None:
+                cur_dec_out.data.masked_fill_(trg_vocab_mask.data, -float('inf'))
+        else:
+            cand_ids, cand_dup, cand_weight, cand_bias = trg_cands
+            cur_dec_out = (torch.bmm(cand_weight, hidden.unsqueeze(2)).squeeze(2) + cand_bias).float()
+            cur_dec_out.masked_fill_(cand_dup, -float('inf'))
+        return F.log_softmax(cur_dec_out, dim=-1)
+
+    def beam_decode(self, dec_inp, dec_hid, encoder_output, src_word_embeds, src_mask, dec_cache, trg_vocab_mask,
+                    trg_cands, time_steps):
+        """Batched beam search, the beams of a sample are kept as consecutive rows of [batch*beam] tensors."""
+        batch_len = encoder_output.size()[0]
+        eos_id = word_vocab['<EOS>']
+        sep_id = word_vocab['|']
+        sample_idx = torch.arange(batch_len, device=encoder_output.device).unsqueeze(1)
+        beam_rows = sample_idx.repeat(1, beam_size).view(-1)
+        beam_base = sample_idx * beam_size
+
+        dec_inp = dec_inp.index_select(0, beam_rows)
+        dec_hid = (dec_hid[0].index_select(0, beam_rows), dec_hid[1].index_select(0, beam_rows))
+        encoder_output = encoder_output.index_select(0, beam_rows)
+        src_word_embeds = src_word_embeds.index_select(0, beam_rows)
+        src_mask = src_mask.index_select(0, beam_rows)
+        dec_cache = tuple(c.index_select(0, beam_rows) for c in dec_cache)
+        if trg_vocab_mask is not None:
+            trg_vocab_mask = trg_vocab_mask.index_select(0, beam_rows)
+        if trg_cands is None:
+            vocab_size = len(word_vocab)
+            eos_col = beam_rows.new_full((beam_rows.size(0), 1), eos_id)
+            sep_col = beam_rows.new_full((beam_rows.size(0), 1), sep_id)
+        else:
+            trg_cands = tuple(c.index_select(0, beam_rows) for c in trg_cands)
+            vocab_size = trg_cands[0].size(1)
+            # the first occurrence of an id in the sorted candidates is the one left unmasked
+            eos_col = trg_cands[0].lt(eos_id).sum(dim=1, keepdim=True)
+            sep_col = trg_cands[0].lt(sep_id).sum(dim=1, keepdim=True)
+
+        # only the first beam of every sample is alive before the first step
+        beam_scores = encoder_output.new_full((batch_len, beam_size), -float('inf'), dtype=torch.float)
+        beam_scores[:, 0] = 0
+        beam_lens = beam_rows.new_zeros(beam_rows.size())
+        sep_counts = beam_rows.new_zeros(beam_rows.size())
+        finished = src_mask.new_zeros(beam_rows.size())
+
+        step_words = []
+        step_attns = []
+        step_parents = []
+        for t in range(time_steps):
+            dec_hid, cur_dec_attn = self.decoder.step(dec_inp, dec_hid, encoder_output, src_mask, dec_cache)
+            cur_dec_out = self.get_step_log_probs(dec_hid[0], trg_vocab_mask, trg_cands)
+            if beam_max_tuples > 0:
+                sep_scores = cur_dec_out.gather(1, sep_col)
+                sep_scores.masked_fill_((sep_counts >= beam_max_tuples - 1).unsqueeze(1), -float('inf'))
+                cur_dec_out.scatter_(1, sep_col, sep_scores)
+            # a finished hypothesis can only be extended by <EOS>, which keeps its score
+            cur_dec_out.masked_fill_(finished.unsqueeze(1), -float('inf'))
+            eos_scores = cur_dec_out.gather(1, eos_col).masked_fill_(finished.unsqueeze(1), 0)
+            cur_dec_out.scatter_(1, eos_col, eos_scores)
+
+            scores = beam_scores.view(-1, 1) + cur_dec_out
+            beam_scores, top_idx = scores.view(batch_len, -1).topk(beam_size, dim=-1)
+            parents = (beam_base + top_idx // vocab_size).view(-1)
+            words = (top_idx % vocab_size).view(-1)
+            if trg_cands is not None:
+                # every beam of a sample has the same candidates, so the new row can map its own column
+                words = trg_cands[0].gather(1, words.unsqueeze(1)).view(-1)
+
+            dec_hid = (dec_hid[0].index_select(0, parents), dec_hid[1].index_select(0, parents))
+            prev_finished = finished.index_select(0, parents)
+            beam_lens = beam_lens.index_select(0, parents) + prev_finished.eq(0).long()
+            sep_counts = sep_counts.index_select(0, parents) + words.eq(sep_id).long()
+            finished = prev_finished | words.eq(eos_id)
+
+            step_words.append(words)
+            step_attns.append(cur_dec_attn.topk(1)[1].view(-1).index_select(0, parents))
+            step_parents.append(parents)
+            if finished.all():
+                break
+            dec_inp = self.word_embeddings(words)
+
+        # unfinished hypotheses are scored by their full length
+        len_penalty = ((5.0 + beam_lens.float()) / 6.0) ** beam_len_penalty
+        best_rows = (beam_scores.view(-1) / len_penalty).view(batch_len, -1).argmax(dim=-1) + beam_base.view(-1)
+
+        # decoding may stop early, the remaining steps are padded with <EOS>
+        dec_out_i = beam_rows.new_full((batch_len, time_steps), eos_id)
+        dec_attn_i = beam_rows.new_zeros((batch_len, time_steps))
+        for t in range(len(step_words) - 1, -1, -1):
+            dec_out_i[:, t] = step_words[t].index_select(0, best_rows)
+            dec_attn_i[:, t] = step_attns[t].index_select(0, best_rows)
+            best_rows = step_parents[t].index_select(0, best_rows)
+        return dec_out_i, dec_attn_i
+
+    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, is_training=False,
+                trg_cand_ids=None):
         src_word_embeds = self.word_embeddings(src_words_seq)
         trg_word_embeds = self.word_embeddings(trg_words_seq)
 
@@ -857,55 +1549,75 @@ class SeqToSeqModel(nn.Module):
         else:
             time_steps = max_trg_len
 
-        encoder_output = self.encoder(src_word_embeds, src_chars_seq, adj, is_training)
+        encoder_output = self.encoder(src_word_embeds, src_chars_seq, adj, src_mask, is_training)
+        trg_vocab_mask = None
+        trg_cands = None
+        if copy_on and not is_training:
+            if restricted_decode:
+                trg_cands = self.get_trg_cands(trg_vocab_ids)
+            else:
+                trg_vocab_mask = self.get_trg_vocab_mask(trg_vocab_ids)
 
-        h0 = autograd.Variable(torch.FloatTensor(torch.zeros(batch_len, word_embed_dim)))
-        h0 = h0.cuda()
-        c0 = autograd.Variable(torch.FloatTensor(torch.zeros(batch_len, word_embed_dim)))
-        c0 = c0.cuda()
+        dec_cache = self.decoder.init_cache(encoder_output, src_word_embeds, src_mask)
+        h0 = encoder_output.new_zeros((batch_len, word_embed_dim))
+        c0 = encoder_output.new_zeros((batch_len, word_embed_dim))
         dec_hid = (h0, c0)
 
         if is_training:
-            dec_inp = trg_word_embeds[:, 0, :]
-            dec_out, dec_hid, dec_attn = self.decoder(dec_inp, dec_hid, encoder_output, src_word_embeds,
-                                                      src_mask, is_training)
-            dec_out = dec_out.view(-1, len(word_vocab))
-            dec_out = F.log_softmax(dec_out, dim=-1)
-            dec_out = dec_out.unsqueeze(1)
-            for t in range(1, time_steps):
-                dec_inp = trg_word_embeds[:, t, :]
-                cur_dec_out, dec_hid, dec_attn = self.decoder(dec_inp, dec_hid, encoder_output, src_word_embeds,
-                                                              src_mask, is_training)
-                cur_dec_out = cur_dec_out.view(-1, len(word_vocab))
-                dec_out = torch.cat((dec_out, F.log_softmax(cur_dec_out, dim=-1).unsqueeze(1)), 1)
+            # the recurrence runs first, the vocabulary projection and softmax then cover all steps at once
+            dec_hs = self.decoder.run_steps(trg_word_embeds[:, :time_steps, :], dec_hid, encoder_output, src_mask,
+                                            dec_cache)
+            if trg_cand_ids is None:
+                dec_out = F.log_softmax(self.decoder.ent_out(dec_hs).float(), dim=-1)
+            else:
+                # the softmax only covers the candidate ids of the batch, every row of trg_cand_ids holds all of them
+                cand_ids = trg_cand_ids[0]
+                cand_weight = self.decoder.ent_out.weight.index_select(0, cand_ids)
+                cand_bias = self.decoder.ent_out.bias.index_select(0, cand_ids)
+                dec_out = F.log_softmax(F.linear(dec_hs, cand_weight, cand_bias).float(), dim=-1)
+        elif beam_size > 1:
+            dec_out_i, dec_attn_i = self.beam_decode(trg_word_embeds[:, 0, :], dec_hid, encoder_output,
+                                                     src_word_embeds, src_mask, dec_cache, trg_vocab_mask, trg_cands,
+                                                     time_steps)
         else:
+            eos_id = word_vocab['<EOS>']
+            dec_out_i = src_words_seq.new_full((batch_len, time_steps), eos_id)
+            dec_attn_i = src_words_seq.new_zeros((batch_len, time_steps))
+            active_rows = torch.arange(batch_len, device=src_words_seq.device)
+            finished = src_mask.new_zeros(batch_len)
             dec_inp = trg_word_embeds[:, 0, :]
-            dec_out, dec_hid, dec_attn = self.decoder(dec_inp, dec_hid, encoder_output, src_word_embeds,
-                                                      src_mask, is_training)
-            dec_out = dec_out.view(-1, len(word_vocab))
-            if copy_on:
-                dec_out.data.masked_fill_(trg_vocab_mask.data, -float('inf'))
-            dec_out = F.log_softmax(dec_out, dim=-1)
-            topv, topi = dec_out.topk(1)
-            dec_out_v, dec_out_i = dec_out.topk(1)
-            dec_attn_v, dec_attn_i = dec_attn.topk(1)
-
-            for t in range(1, time_steps):
-                dec_inp = self.word_embeddings(topi.squeeze().detach())
-                cur_dec_out, dec_hid, cur_dec_attn = self.decoder(dec_inp, dec_hid, encoder_output, src_word_embeds,
-                                                                  src_mask, is_training)
-                cur_dec_out = cur_dec_out.view(-1, len(word_vocab))
-                if copy_on:
-                    cur_dec_out.data.masked_fill_(trg_vocab_mask.data, -float('inf'))
-                cur_dec_out = F.log_softmax(cur_dec_out, dim=-1)
+            for t in range(time_steps):
+                dec_hid, cur_dec_attn = self.decoder.step(dec_inp, dec_hid, encoder_output, src_mask, dec_cache)
+                cur_dec_out = self.get_step_log_probs(dec_hid[0], trg_vocab_mask, trg_cands)
                 topv, topi = cur_dec_out.topk(1)
-                cur_dec_out_v, cur_dec_out_i = cur_dec_out.topk(1)
-                dec_out_i = torch.cat((dec_out_i, cur_dec_out_i), 1)
+                if trg_cands is not None:
+                    topi = trg_cands[0].gather(1, topi)
                 cur_dec_attn_v, cur_dec_attn_i = cur_dec_attn.topk(1)
-                dec_attn_i = torch.cat((dec_attn_i, cur_dec_attn_i), 1)
+                # sequences that already emitted <EOS> keep emitting it
+                topi.masked_fill_(finished.unsqueeze(1), eos_id)
+                dec_out_i[active_rows, t] = topi.view(-1)
+                dec_attn_i[active_rows, t] = cur_dec_attn_i.view(-1)
+                finished = finished | topi.view(-1).eq(eos_id)
+                if finished.all():
+                    break
+                if decode_shrink_batch and finished.any():
+                    keep_rows = finished.eq(0).nonzero().view(-1)
+                    active_rows = active_rows.index_select(0, keep_rows)
+                    dec_hid = (dec_hid[0].index_select(0, keep_rows), dec_hid[1].index_select(0, keep_rows))
+                    encoder_output = encoder_output.index_select(0, keep_rows)
+                    src_word_embeds = src_word_embeds.index_select(0, keep_rows)
+                    src_mask = src_mask.index_select(0, keep_rows)
+                    dec_cache = tuple(c.index_select(0, keep_rows) for c in dec_cache)
+                    if trg_vocab_mask is not None:
+                        trg_vocab_mask = trg_vocab_mask.index_select(0, keep_rows)
+                    if trg_cands is not None:
+                        trg_cands = tuple(c.index_select(0, keep_rows) for c in trg_cands)
+                    topi = topi.index_select(0, keep_rows)
+                    finished = finished.index_select(0, keep_rows)
+                dec_inp = self.word_embeddings(topi.view(-1).detach())
 
         if is_training:
-            dec_out = dec_out.view(-1, len(word_vocab))
+            dec_out = dec_out.view(-1, dec_out.size(-1))
             return dec_out, encoder_output
         else:
             return dec_out_i, dec_attn_i
@@ -916,11 +1628,13 @@ class StuModel(nn.Module):
         super(StuModel, self).__init__()
         self.stuSeqModel = SeqToSeqModel()
 
-    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, is_training=False):
+    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, is_training=False,
+                trg_cand_ids=None):
         if is_training:
-            dec_out, encoder_output = self.stuSeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, True)
+            dec_out, encoder_output = self.stuSeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, True,
+                                                         trg_cand_ids)
         else:
-            outputs = self.stuSeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, False)
+            outputs = self.stuSeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, False)
 
         if is_training:
             return dec_out, encoder_output
@@ -933,11 +1647,13 @@ class Tea1Model(nn.Module):
         super(Tea1Model, self).__init__()
         self.tea1SeqModel = SeqToSeqModel()
 
-    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, is_training=False):
+    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, is_training=False,
+                trg_cand_ids=None):
         if is_training:
-            dec_out, encoder_output = self.tea1SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, True)
+            dec_out, encoder_output = self.tea1SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, True,
+                                                         trg_cand_ids)
         else:
-            outputs = self.tea1SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, False)
+            outputs = self.tea1SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, False)
 
         if is_training:
             return dec_out, encoder_output
@@ -950,11 +1666,13 @@ class Tea2Model(nn.Module):
         super(Tea2Model, self).__init__()
         self.tea2SeqModel = SeqToSeqModel()
 
-    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, is_training=False):
+    def forward(self, src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, is_training=False,
+                trg_cand_ids=None):
         if is_training:
-            dec_out, encoder_output = self.tea2SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, True)
+            dec_out, encoder_output = self.tea2SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, True,
+                                                         trg_cand_ids)
         else:
-            outputs = self.tea2SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_mask, adj, False)
+            outputs = self.tea2SeqModel(src_words_seq, src_chars_seq, src_mask, trg_words_seq, trg_vocab_ids, adj, False)
 
         if is_training:
             return dec_out, encoder_output
@@ -977,11 +1695,6 @@ def get_model(model_id):
 
 def predict(samples, model, model_id, model_name):
     pred_batch_size = batch_size
-    batch_count = math.ceil(len(samples) / pred_batch_size)
-    move_last_batch = False
-    if len(samples) - batch_size * (batch_count - 1) == 1:
-        move_last_batch = True
-        batch_count -= 1
     preds = list()
     attns = list()
 
@@ -989,93 +1702,40 @@ def predict(samples, model, model_id, model_name):
     set_random_seeds(random_seed)
     start_time = datetime.datetime.now()
 
-    for batch_idx in range(0, batch_count):
-        batch_start = batch_idx * pred_batch_size
-        batch_end = min(len(samples), batch_start + pred_batch_size)
-        if batch_idx == batch_count - 1 and move_last_batch:
-            batch_end = len(samples)
-
-        cur_batch = samples[batch_start:batch_end]
-        cur_samples_input = get_batch_data(cur_batch, False)
-
-        src_words_seq = torch.from_numpy(cur_samples_input['src_words'].astype('long'))
-        src_words_mask = torch.from_numpy(cur_samples_input['src_words_mask'].astype('uint8'))
-        src_chars_seq = torch.from_numpy(cur_samples_input['src_chars'].astype('long'))
-
-        # tea1
-        src_tea1_words_seq = torch.from_numpy(cur_samples_input['src_tea1_words'].astype('long'))
-        src_tea1_words_mask = torch.from_numpy(cur_samples_input['src_tea1_words_mask'].astype('uint8'))
-        src_tea1_chars_seq = torch.from_numpy(cur_samples_input['src_tea1_chars'].astype('long'))
-
-        # tea2
-        src_tea2_words_seq = torch.from_numpy(cur_samples_input['src_tea2_words'].astype('long'))
-        src_tea2_words_mask = torch.from_numpy(cur_samples_input['src_tea2_words_mask'].astype('uint8'))
-        src_tea2_chars_seq = torch.from_numpy(cur_samples_input['src_tea2_chars'].astype('long'))
-
-        trg_stu_vocab_mask = torch.from_numpy(cur_samples_input['trg_stu_vocab_mask'].astype('uint8'))
-        trg_tea1_vocab_mask = torch.from_numpy(cur_samples_input['trg_tea1_vocab_mask'].astype('uint8'))
-        trg_tea2_vocab_mask = torch.from_numpy(cur_samples_input['trg_tea2_vocab_mask'].astype('uint8'))
-        trg_words_seq = torch.from_numpy(cur_samples_input['trg_words'].astype('long'))
-        adj = torch.from_numpy(cur_samples_input['adj'].astype('float32'))
-
-        if torch.cuda.is_available():
-            src_words_seq = src_words_seq.cuda()
-            src_words_mask = src_words_mask.cuda()
-
-            src_tea1_words_seq = src_tea1_words_seq.cuda()
-            src_tea1_words_mask = src_tea1_words_mask.cuda()
-            src_tea2_words_seq = src_tea2_words_seq.cuda()
-            src_tea2_words_mask = src_tea2_words_mask.cuda()
-
-            trg_stu_vocab_mask = trg_stu_vocab_mask.cuda()
-            trg_tea1_vocab_mask = trg_tea1_vocab_mask.cuda()
-            trg_tea2_vocab_mask = trg_tea2_vocab_mask.cuda()
-            trg_words_seq = trg_words_seq.cuda()
-            adj = adj.cuda()
-            src_chars_seq = src_chars_seq.cuda()
-            src_tea1_chars_seq = src_tea1_chars_seq.cuda()
-            src_tea2_chars_seq = src_tea2_chars_seq.cuda()
-
-        # autograd
-        src_words_seq = Variable(src_words_seq)
-        src_words_mask = Variable(src_words_mask)
-        src_tea1_words_seq = Variable(src_tea1_words_seq)
-        src_tea1_words_mask = Variable(src_tea1_words_mask)
-        src_tea2_words_seq = Variable(src_tea2_words_seq)
-        src_tea2_words_mask = Variable(src_tea2_words_mask)
-        trg_stu_vocab_mask = Variable(trg_stu_vocab_mask)
-        trg_tea1_vocab_mask = Variable(trg_tea1_vocab_mask)
-        trg_tea2_vocab_mask = Variable(trg_tea2_vocab_mask)
-        adj = Variable(adj)
-        src_chars_seq = Variable(src_chars_seq)
-        src_tea1_chars_seq = Variable(src_tea1_chars_seq)
-        src_tea2_chars_seq = Variable(src_tea2_chars_seq)
-
-        trg_words_seq = Variable(trg_words_seq)
-        with torch.no_grad():
+    prefetcher = BatchPrefetcher(get_batches(samples, pred_batch_size), False)
+    for cur_batch, cur_samples_input in prefetcher:
+        with torch.no_grad(), get_autocast(predict_dtype):
             if model_id == 1:
-                if model_name == "stu":
-                    # last parameter False : no_training
-                    outputs = model(src_words_seq, src_chars_seq, src_words_mask, trg_words_seq, trg_stu_vocab_mask, adj, False)
-                elif model_name == "tea1":
-                    outputs = model(src_tea1_words_seq, src_tea1_chars_seq, src_tea1_words_mask, trg_words_seq, trg_tea1_vocab_mask, adj, False)
-                elif model_name == "tea2":
-                    outputs = model(src_tea2_words_seq, src_tea2_chars_seq, src_tea2_words_mask, trg_words_seq, trg_tea2_vocab_mask, adj, False)
+                # last parameter False : no_training
+                outputs = model(*get_model_inputs(cur_samples_input, model_name), False)
 
         preds += list(outputs[0].data.cpu().numpy())
         attns += list(outputs[1].data.cpu().numpy())
         model.zero_grad()
     end_time = datetime.datetime.now()
     custom_print('Prediction time:', end_time - start_time)
+    custom_print('Prediction data stall time:', prefetcher.stall_time)
     return preds, attns
 
 def best_dev_F1(dev_samples, train_model, model_id, model_name, epoch_idx, train_outputs, cur_batch, cur_samples_input):
     dev_preds, dev_attns = predict(dev_samples, train_model, model_id, model_name)
-    torch.cuda.synchronize()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
     seq_p, seq_r, seq_f = get_F1(dev_samples, dev_preds, dev_attns, model_name)
     custom_print('seq_p, seq_r, seq_f:', model_name, '\t', seq_p, seq_r, seq_f)
     return seq_f
 
+def load_model_state(model, model_file):
+    # checkpoints saved from a DataParallel model carry a 'module.' prefix, so they are remapped either way
+    state_dict = torch.load(model_file, map_location=device)
+    is_parallel = isinstance(model, torch.nn.DataParallel)
+    model_state = OrderedDict()
+    for name in state_dict:
+        key = name[len('module.'):] if name.startswith('module.') else name
+        model_state['module.' + key if is_parallel else key] = state_dict[name]
+    model.load_state_dict(model_state)
+
+
 def save_best_model(cur_f, best_dev_f, epoch_idx, cur_seed, train_model, best_model_file, model_name):
     best_epoch_idx = epoch_idx + 1
     best_epoch_seed = cur_seed
@@ -1086,23 +1746,224 @@ def save_best_model(cur_f, best_dev_f, epoch_idx, cur_seed, train_model, best_mo
     custom_print('Best Epoch seq F1:', model_name, '\t', best_dev_f)
 
 
+def get_samples_key(samples):
+    # the cached targets follow the shuffled tuple order of every sample, so the key covers the target words
+    md5 = hashlib.md5()
+    for sample in samples:
+        md5.update((str(sample.Id) + ' ' + ' '.join(sample.TrgWords) + '\n').encode('utf-8'))
+    return md5.hexdigest()
+
+
+def build_teacher_cache(cache_dir, samples, tea_models, tea_model_files, samples_key):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    meta_file = os.path.join(cache_dir, 'meta.pkl')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    names = ["tea1", "tea2"]
+    for model in tea_models:
+        model.eval()
+    ids = np.array([sample.Id for sample in samples], dtype=np.int64)
+    offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([sample.TrgLen - 1 for sample in samples])
+    targets = dict((name, np.zeros(offsets[-1], dtype=np.int32)) for name in names)
+    topk_ids = dict((name, np.zeros((offsets[-1], teacher_cache_topk), dtype=np.int32)) for name in names)
+    topk_logps = dict((name, np.zeros((offsets[-1], teacher_cache_topk), dtype=np.float16)) for name in names)
+
+    sample_idx = 0
+    for cur_batch, cur_samples_input in BatchPrefetcher(get_batches(samples, batch_size), True):
+        for model, name in zip(tea_models, names):
+            with torch.no_grad():
+                outputs, encoder_output = model(*get_model_inputs(cur_samples_input, name), True)
+            outputs = outputs.view(len(cur_batch), -1, len(word_vocab))
+            cur_targets = outputs.argmax(dim=-1).cpu().numpy()
+            if teacher_cache_topk > 0:
+                cur_topk_logps, cur_topk_ids = outputs.topk(teacher_cache_topk, dim=-1)
+                cur_topk_logps = cur_topk_logps.cpu().numpy()
+                cur_topk_ids = cur_topk_ids.cpu().numpy()
+            for i in range(len(cur_batch)):
+                start, end = offsets[sample_idx + i], offsets[sample_idx + i + 1]
+                targets[name][start:end] = cur_targets[i, :end - start]
+                if teacher_cache_topk > 0:
+                    topk_ids[name][start:end] = cur_topk_ids[i, :end - start]
+                    topk_logps[name][start:end] = cur_topk_logps[i, :end - start]
+        sample_idx += len(cur_batch)
+
+    np.save(os.path.join(cache_dir, 'ids.npy'), ids)
+    np.save(os.path.join(cache_dir, 'offsets.npy'), offsets)
+    for name in names:
+        np.save(os.path.join(cache_dir, name + '_targets.npy'), targets[name])
+        if teacher_cache_topk > 0:
+            np.save(os.path.join(cache_dir, name + '_topk_ids.npy'), topk_ids[name])
+            np.save(os.path.join(cache_dir, name + '_topk_logps.npy'), topk_logps[name])
+    write_cache_meta(meta_file, {'version': teacher_cache_version,
+                                 'sources': [get_file_signature(f) for f in tea_model_files],
+                                 'samples_key': samples_key, 'topk': teacher_cache_topk})
+
+
+class TeacherCache(object):
+    """
+    Memory-mapped teacher argmax targets (and optionally top-k log-probs) of the training samples, keyed by sample Id
+    """
+    def __init__(self, cache_dir, meta):
+        self.topk = meta['topk']
+        offsets = np.load(os.path.join(cache_dir, 'offsets.npy'))
+        ids = np.load(os.path.join(cache_dir, 'ids.npy'))
+        self.spans = dict((uid, (offsets[i], offsets[i + 1])) for i, uid in enumerate(ids.tolist()))
+        self.arrays = dict()
+        for name in ["tea1", "tea2"]:
+            self.arrays[name] = np.load(os.path.join(cache_dir, name + '_targets.npy'), mmap_mode='r')
+            if self.topk > 0:
+                self.arrays[name + '_topk_ids'] = np.load(os.path.join(cache_dir, name + '_topk_ids.npy'),
+                                                          mmap_mode='r')
+                self.arrays[name + '_topk_logps'] = np.load(os.path.join(cache_dir, name + '_topk_logps.npy'),
+                                                            mmap_mode='r')
+
+    def get_batch(self, cur_batch, name, max_len):
+        # padded steps get target 0, which NLLLoss(ignore_index=0) skips
+        targets = np.zeros((len(cur_batch), max_len), dtype=np.int64)
+        if self.topk > 0:
+            topk_ids = np.zeros((len(cur_batch), max_len, self.topk), dtype=np.int64)
+            topk_logps = np.zeros((len(cur_batch), max_len, self.topk), dtype=np.float32)
+        for i, sample in enumerate(cur_batch):
+            start, end = self.spans[sample.Id]
+            targets[i, :end - start] = self.arrays[name][start:end]
+            if self.topk > 0:
+                topk_ids[i, :end - start] = self.arrays[name + '_topk_ids'][start:end]
+                topk_logps[i, :end - start] = self.arrays[name + '_topk_logps'][start:end]
+        if self.topk > 0:
+            return targets, topk_ids, topk_logps
+        return targets, None, None
+
+
+def load_teacher_cache(cache_dir, samples, tea_models, tea_model_files):
+    samples_key = get_samples_key(samples)
+    meta = load_cache_meta(os.path.join(cache_dir, 'meta.pkl'), tea_model_files)
+    if meta is None or meta['version'] != teacher_cache_version or meta['samples_key'] != samples_key or \
+            meta['topk'] != teacher_cache_topk:
+        custom_print('building teacher cache:', cache_dir)
+        build_teacher_cache(cache_dir, samples, tea_models, tea_model_files, samples_key)
+        meta = load_cache_meta(os.path.join(cache_dir, 'meta.pkl'), tea_model_files)
+    return TeacherCache(cache_dir, meta)
+
+
+def get_topk_loss(outputs, topk_ids, topk_logps, target):
+    # cross entropy against the teacher distribution renormalized over its top-k words
+    topk_probs = F.softmax(topk_logps.view(-1, topk_logps.size(-1)), dim=-1)
+    step_loss = -(topk_probs * outputs.gather(1, topk_ids.view(-1, topk_ids.size(-1)))).sum(dim=1)
+    step_mask = target.ne(0).float()
+    return (step_loss * step_mask).sum() / step_mask.sum()
+
+
+def get_cached_teacher_loss(teacher_cache, cur_batch, batch_tensors, stu_outputs, target, target_len, criterion):
+    loss = 0
+    for name, arg_w in (("tea1", arg_w_tea1), ("tea2", arg_w_tea2)):
+        tea_target, topk_ids, topk_logps = teacher_cache.get_batch(cur_batch, name, target_len)
+        if 'trg_cand_ids' in batch_tensors:
+            # cached targets outside the candidates of the batch fall back to the ignored id 0
+            trg_cand_ids = batch_tensors['trg_cand_ids'].cpu().numpy()
+            cand_pos = np.minimum(np.searchsorted(trg_cand_ids, tea_target), len(trg_cand_ids) - 1)
+            tea_target = np.where(trg_cand_ids[cand_pos] == tea_target, cand_pos, 0)
+        if topk_ids is None:
+            tea_target = torch.from_numpy(tea_target).to(device).view(-1)
+            loss = loss + arg_w * criterion(stu_outputs, tea_target)
+        else:
+            topk_ids = torch.from_numpy(topk_ids).to(device)
+            topk_logps = torch.from_numpy(topk_logps).to(device)
+            loss = loss + arg_w * get_topk_loss(stu_outputs, topk_ids, topk_logps, target)
+    return loss
+
+
+def get_autocast(dtype_name):
+    # autocast needs torch >= 1.10, older versions always run in float32
+    if dtype_name == 'float32' or not hasattr(torch, 'autocast'):
+        return contextlib.ExitStack()
+    return torch.autocast(device.type, dtype=getattr(torch, dtype_name))
+
+
+def get_grad_scaler():
+    if train_dtype != 'float16' or device.type != 'cuda' or not hasattr(torch.cuda, 'amp'):
+        return None
+    return torch.cuda.amp.GradScaler()
+
+
+def optimize_step(loss, models, optimizers, scaler, is_update_step):
+    if scaler is None:
+        loss.backward()
+        for model in models:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 10.0)  # clipping gradient
+    else:
+        scaler.scale(loss).backward()
+        # scaled gradients can only be unscaled once per update, so they are clipped right before it
+        if is_update_step:
+            for model, optimizer in zip(models, optimizers):
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), 10.0)
+
+    if is_update_step:
+        for optimizer in optimizers:
+            if scaler is None:
+                optimizer.step()
+            else:
+                scaler.step(optimizer)
+        if scaler is not None:
+            scaler.update()
+        for model in models:
+            model.zero_grad()
+
+
+def get_cand_ids(batch_tensors):
+    if 'trg_cand_ids' not in batch_tensors:
+        return None
+    # expanded per row, so that DataParallel hands every replica the full candidate list
+    batch_len = batch_tensors['trg_words'].size(0)
+    return batch_tensors['trg_cand_ids'].unsqueeze(0).expand(batch_len, -1)
+
+
+def forward_model(model, model_inputs, stream, trg_cand_ids=None):
+    # autocast is thread local, so it is entered here rather than around the worker threads
+    if stream is None:
+        with get_autocast(train_dtype):
+            return model(*model_inputs, True, trg_cand_ids)
+    with torch.cuda.stream(stream), get_autocast(train_dtype):
+        return model(*model_inputs, True, trg_cand_ids)
+
+
+def forward_models(models, batch_tensors, executor, streams):
+    # the models have separate weights, so they can only overlap, not share a batch
+    model_names = ["stu", "tea1", "tea2"]
+    trg_cand_ids = get_cand_ids(batch_tensors)
+    if executor is None:
+        return [forward_model(model, get_model_inputs(batch_tensors, name), None, trg_cand_ids)
+                for model, name in zip(models, model_names)]
+    if streams is None:
+        streams = [None] * len(models)
+    else:
+        main_stream = torch.cuda.current_stream()
+        for stream in streams:
+            stream.wait_stream(main_stream)
+    futures = [executor.submit(forward_model, model, get_model_inputs(batch_tensors, name), stream, trg_cand_ids)
+               for model, name, stream in zip(models, model_names, streams)]
+    outputs = [future.result() for future in futures]
+    if streams[0] is not None:
+        for stream in streams:
+            main_stream.wait_stream(stream)
+    return outputs
+
+
 def train_model(model_id, train_samples, dev_samples, best_stu_model_file, best_tea1_model_file, best_tea2_model_file, tea_ts_mode):
-    train_size = len(train_samples)
-    batch_count = int(math.ceil(train_size/batch_size))
-    move_last_batch = False
-    if len(train_samples) - batch_size * (batch_count - 1) == 1:
-        move_last_batch = True
-        batch_count -= 1
-    custom_print("batch_count",  batch_count)
+    if not stream_data and max_batch_tokens > 0:
+        custom_print("batch_count",  len(pack_token_batches(sorted(train_samples, key=lambda x: (x.SrcLen, x.TrgLen)))))
+    elif not stream_data:
+        custom_print("batch_count",  len(get_batches(train_samples, batch_size)))
     stu_model, tea1_model, tea2_model = get_model(model_id)
     pytorch_total_params = sum(p.numel() for p in stu_model.parameters() if p.requires_grad)
     custom_print('stu_model Parameters size:', pytorch_total_params)
     # custom_print("stu_model, tea1_model, tea2_model, ", stu_model, tea1_model, tea2_model)
 
-    if torch.cuda.is_available():
-        stu_model.cuda()
-        tea1_model.cuda()
-        tea2_model.cuda()
+    stu_model.to(device)
+    tea1_model.to(device)
+    tea2_model.to(device)
     if n_gpu > 1:
         stu_model = torch.nn.DataParallel(stu_model)
         tea1_model = torch.nn.DataParallel(tea1_model)
@@ -1112,12 +1973,32 @@ def train_model(model_id, train_samples, dev_samples, best_stu_model_file, best_
     #     tea1_model.load_state_dict(torch.load(best_tea1_model_file))
     #     tea2_model.load_state_dict(torch.load(best_tea2_model_file))
 
+    teacher_cache = None
+    if tea_ts_mode == "stu_cached":
+        if stream_data:
+            raise ValueError('stu_cached needs the training data in memory, set stream_data = False')
+        if candidate_softmax and teacher_cache_topk > 0:
+            raise ValueError('cached top-k teacher targets need the full softmax, set candidate_softmax = False')
+        # the teachers are already trained, they only run once to fill the cache
+        tea_model_files = [best_tea1_model_file, best_tea2_model_file]
+        load_model_state(tea1_model, best_tea1_model_file)
+        load_model_state(tea2_model, best_tea2_model_file)
+        teacher_cache = load_teacher_cache(teacher_cache_folder, train_samples, (tea1_model, tea2_model),
+                                           tea_model_files)
+
+    # stu, tea1 and tea2 run on worker threads, each with its own CUDA stream on a single GPU
+    model_executor = ThreadPoolExecutor(3) if concurrent_models else None
+    model_streams = None
+    if concurrent_models and device.type == 'cuda' and n_gpu <= 1:
+        model_streams = [torch.cuda.Stream() for i in range(3)]
+
     criterion = nn.NLLLoss(ignore_index=0)
     stu_tea1_attentionMap = AttentionMap()
     stu_tea2_attentionMap = AttentionMap()
     stu_optimizer = optim.Adam(stu_model.parameters(), lr=0.0002)
     tea1_optimizer = optim.Adam(tea1_model.parameters(), lr=0.0002)
     tea2_optimizer = optim.Adam(tea2_model.parameters(), lr=0.0002)
+    scaler = get_grad_scaler()
 
     stu_best_dev_f1 = -1.0
     tea1_best_dev_f1 = -1.0
@@ -1125,129 +2006,76 @@ def train_model(model_id, train_samples, dev_samples, best_stu_model_file, best_
     stu_best_epoch_idx = -1
     stu_best_epoch_seed = -1
 
-    if tea_ts_mode == "ts":
+    if tea_ts_mode in ("ts", "stu_cached"):
         for epoch_idx in range(0, num_epoch):
             stu_model.train()
-            tea1_model.train()
-            tea2_model.train()
             stu_model.zero_grad()
-            tea1_model.zero_grad()
-            tea2_model.zero_grad()
+            if teacher_cache is None:
+                tea1_model.train()
+                tea2_model.train()
+                tea1_model.zero_grad()
+                tea2_model.zero_grad()
             custom_print('Epoch:', epoch_idx + 1)
             cur_seed = random_seed + epoch_idx + 1
             set_random_seeds(cur_seed)
-            cur_shuffled_train_data = shuffle_data(train_samples)
+            if stream_data:
+                cur_batches = bucket_batches(train_samples, stream_buffer_size)
+            elif max_batch_tokens > 0:
+                cur_batches = get_bucket_batches(list(train_samples))
+            else:
+                cur_batches = get_batches(shuffle_data(train_samples), batch_size)
 
             start_time = datetime.datetime.now()
             stu_train_loss_val = 0.0
             tea1_train_loss_val = 0.0
             tea2_train_loss_val = 0.0
 
-            for batch_idx in tqdm(range(0, batch_count)):
-                batch_start = batch_idx * batch_size
-                batch_end = min(len(cur_shuffled_train_data), batch_start + batch_size)
-                if batch_idx == batch_count - 1 and move_last_batch:
-                    batch_end = len(cur_shuffled_train_data)
-                cur_batch = cur_shuffled_train_data[batch_start:batch_end]
-                cur_samples_input = get_batch_data(cur_batch, True)
-
-                # stu
-                src_words_seq = torch.from_numpy(cur_samples_input['src_words'].astype('long'))
-                src_words_mask = torch.from_numpy(cur_samples_input['src_words_mask'].astype('uint8'))
-                src_chars_seq = torch.from_numpy(cur_samples_input['src_chars'].astype('long'))
-
-                # tea1,
-                src_tea1_words_seq = torch.from_numpy(cur_samples_input['src_tea1_words'].astype('long'))
-                src_tea1_words_mask = torch.from_numpy(cur_samples_input['src_tea1_words_mask'].astype('uint8'))
-                src_tea1_chars_seq = torch.from_numpy(cur_samples_input['src_tea1_chars'].astype('long'))
-
-                # tea2，
-                src_tea2_words_seq = torch.from_numpy(cur_samples_input['src_tea2_words'].astype('long'))
-                src_tea2_words_mask = torch.from_numpy(cur_samples_input['src_tea2_words_mask'].astype('uint8'))
-                src_tea2_chars_seq = torch.from_numpy(cur_samples_input['src_tea2_chars'].astype('long'))
-
-                trg_stu_vocab_mask = torch.from_numpy(cur_samples_input['trg_stu_vocab_mask'].astype('uint8'))
-                trg_tea1_vocab_mask = torch.from_numpy(cur_samples_input['trg_tea1_vocab_mask'].astype('uint8'))
-                trg_tea2_vocab_mask = torch.from_numpy(cur_samples_input['trg_tea2_vocab_mask'].astype('uint8'))
-                trg_words_seq = torch.from_numpy(cur_samples_input['trg_words'].astype('long'))
-                adj = torch.from_numpy(cur_samples_input['adj'].astype('float32'))
-
-                target = torch.from_numpy(cur_samples_input['target'].astype('long'))
-                #
-                if torch.cuda.is_available():
-                    src_words_seq = src_words_seq.cuda()
-                    src_words_mask = src_words_mask.cuda()
-
-                    src_tea1_words_seq = src_tea1_words_seq.cuda()
-                    src_tea1_words_mask = src_tea1_words_mask.cuda()
-                    src_tea2_words_seq = src_tea2_words_seq.cuda()
-                    src_tea2_words_mask = src_tea2_words_mask.cuda()
-
-                    trg_stu_vocab_mask = trg_stu_vocab_mask.cuda()
-                    trg_tea1_vocab_mask = trg_tea1_vocab_mask.cuda()
-                    trg_tea2_vocab_mask = trg_tea2_vocab_mask.cuda()
-                    trg_words_seq = trg_words_seq.cuda()
-                    adj = adj.cuda()
-                    src_chars_seq = src_chars_seq.cuda()
-                    src_tea1_chars_seq = src_tea1_chars_seq.cuda()
-                    src_tea2_chars_seq = src_tea2_chars_seq.cuda()
-
-                    target = target.cuda()
-
-                src_words_seq = Variable(src_words_seq)
-                src_words_mask = Variable(src_words_mask)
-                src_tea1_words_seq = Variable(src_tea1_words_seq)
-                src_tea1_words_mask = Variable(src_tea1_words_mask)
-                src_tea2_words_seq = Variable(src_tea2_words_seq)
-                src_tea2_words_mask = Variable(src_tea2_words_mask)
-                trg_stu_vocab_mask = Variable(trg_stu_vocab_mask)
-                trg_tea1_vocab_mask = Variable(trg_tea1_vocab_mask)
-                trg_tea2_vocab_mask = Variable(trg_tea2_vocab_mask)
-                trg_words_seq = Variable(trg_words_seq)
-                adj = Variable(adj)
-                src_chars_seq = Variable(src_chars_seq)
-                src_tea1_chars_seq = Variable(src_tea1_chars_seq)
-                src_tea2_chars_seq = Variable(src_tea2_chars_seq)
-
-                target = Variable(target)  # [batch_size, max_trg_len]
-                if model_id == 1:
-                    stu_outputs, stu_encoder_outputs = stu_model(src_words_seq, src_chars_seq, src_words_mask, trg_words_seq, trg_stu_vocab_mask, adj,
-                                    True)
-                    tea1_outputs, tea1_encoder_outputs = tea1_model(src_tea1_words_seq, src_tea1_chars_seq, src_tea1_words_mask, trg_words_seq, trg_tea1_vocab_mask, adj,
-                                    True)
-                    tea2_outputs, tea2_encoder_outputs = tea2_model(src_tea2_words_seq, src_tea2_chars_seq, src_tea2_words_mask, trg_words_seq, trg_tea2_vocab_mask, adj,
-                                    True)
-
+            batch_count = 0
+            token_count = 0
+            prefetcher = BatchPrefetcher(cur_batches, True)
+            for batch_idx, (cur_batch, cur_samples_input) in enumerate(tqdm(prefetcher)):
+                target = cur_samples_input['target']  # [batch_size, max_trg_len]
+                if teacher_cache is not None:
+                    stu_outputs, stu_encoder_outputs = forward_model(stu_model, get_model_inputs(cur_samples_input, "stu"),
+                                                                     None, get_cand_ids(cur_samples_input))
+                elif model_id == 1:
+                    model_outputs = forward_models((stu_model, tea1_model, tea2_model), cur_samples_input,
+                                                   model_executor, model_streams)
+                    stu_outputs, stu_encoder_outputs = model_outputs[0]
+                    tea1_outputs, tea1_encoder_outputs = model_outputs[1]
+                    tea2_outputs, tea2_encoder_outputs = model_outputs[2]
+
+                target_len = target.size(1)
                 target = target.view(-1, 1).squeeze()  # [batch_size*max_trg_len]
-                tea1_loss = criterion(tea1_outputs, target)
-                tea2_loss = criterion(tea2_outputs, target)
+                if teacher_cache is None:
+                    tea1_loss = criterion(tea1_outputs, target)
+                    tea2_loss = criterion(tea2_outputs, target)
 
-                _v, tea1_target= torch.max(tea1_outputs, 1)
-                _v, tea2_target= torch.max(tea2_outputs, 1)
+                    # the argmax targets carry no gradient, detaching also drops the teacher graphs from _v
+                    _v, tea1_target= torch.max(tea1_outputs.detach(), 1)
+                    _v, tea2_target= torch.max(tea2_outputs.detach(), 1)
 
                 if epoch_idx < 5:
                     stu_loss = criterion(stu_outputs, target)
+                elif teacher_cache is not None:
+                    stu_loss = criterion(stu_outputs, target) + get_cached_teacher_loss(
+                        teacher_cache, cur_batch, cur_samples_input, stu_outputs, target, target_len, criterion)
                 else:
                     stu_loss = criterion(stu_outputs, target) + arg_w_tea1*criterion(stu_outputs, tea1_target) + arg_w_tea2*criterion(stu_outputs, tea2_target)
 
-                stu_loss.backward(retain_graph=True)
-                tea1_loss.backward(retain_graph=True)
-                tea2_loss.backward(retain_graph=True)
-                torch.nn.utils.clip_grad_norm_(stu_model.parameters(), 10.0)  # clipping gradient
-                torch.nn.utils.clip_grad_norm_(tea1_model.parameters(), 10.0)
-                torch.nn.utils.clip_grad_norm_(tea2_model.parameters(), 10.0)
-
-                if (batch_idx + 1) % update_freq == 0:
-                    stu_optimizer.step()
-                    tea1_optimizer.step()
-                    tea2_optimizer.step()
-                    stu_model.zero_grad()
-                    tea1_model.zero_grad()
-                    tea2_model.zero_grad()
-
+                is_update_step = (batch_idx + 1) % update_freq == 0
+                if teacher_cache is not None:
+                    optimize_step(stu_loss, [stu_model], [stu_optimizer], scaler, is_update_step)
+                else:
+                    # the three models share no parameters, so one backward over the summed losses gives the
+                    # same gradients as three separate ones and frees every graph as it goes
+                    optimize_step(stu_loss + tea1_loss + tea2_loss, [stu_model, tea1_model, tea2_model],
+                                  [stu_optimizer, tea1_optimizer, tea2_optimizer], scaler, is_update_step)
+                    tea1_train_loss_val += tea1_loss.item()
+                    tea2_train_loss_val += tea2_loss.item()
                 stu_train_loss_val += stu_loss.item()
-                tea1_train_loss_val += tea1_loss.item()
-                tea2_train_loss_val += tea2_loss.item()
+                batch_count += 1
+                token_count += sum(sample.SrcLen + sample.TrgLen for sample in cur_batch)
 
             stu_train_loss_val /= batch_count
             tea1_train_loss_val /= batch_count
@@ -1255,6 +2083,8 @@ def train_model(model_id, train_samples, dev_samples, best_stu_model_file, best_
             end_time = datetime.datetime.now()
             custom_print('Training stu_loss, tea1_loss, tea2_loss:', stu_train_loss_val, tea1_train_loss_val, tea2_train_loss_val)
             custom_print('Training time:', end_time - start_time)
+            custom_print('Training tokens/sec:', token_count / max((end_time - start_time).total_seconds(), 1e-8))
+            custom_print('Training data stall time:', prefetcher.stall_time)
 
             custom_print('\nDev Results\n')
             if stu_best_epoch_seed>0:
@@ -1262,10 +2092,16 @@ def train_model(model_id, train_samples, dev_samples, best_stu_model_file, best_
             else:
                 set_random_seeds(random_seed)  # random_seed
 
-            torch.cuda.synchronize()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
 
             stu_seq_f = best_dev_F1(dev_samples, stu_model, model_id, "stu", epoch_idx, stu_outputs, cur_batch, cur_samples_input)
             save_best_model(stu_seq_f, stu_best_dev_f1, epoch_idx, cur_seed, stu_model, best_stu_model_file, "stu")
+            if teacher_cache is not None:
+                custom_print('\n\n')
+                if epoch_idx + 1 - stu_best_epoch_idx >= early_stop_cnt:
+                    break
+                continue
 
             tea1_seq_f = best_dev_F1(dev_samples, tea1_model, model_id, "tea1", epoch_idx, tea1_outputs, cur_batch, cur_samples_input)
             save_best_model(tea1_seq_f, tea1_best_dev_f1, epoch_idx, cur_seed, tea1_model, best_tea1_model_file, "tea1")
@@ -1278,15 +2114,27 @@ def train_model(model_id, train_samples, dev_samples, best_stu_model_file, best_
                 break
 
         custom_print('stu model saved.....:', best_stu_model_file)
-        custom_print('tea1 model saved.....:', best_tea1_model_file)
-        custom_print('tea2 model saved.....:', best_tea2_model_file)
+        if teacher_cache is None:
+            custom_print('tea1 model saved.....:', best_tea1_model_file)
+            custom_print('tea2 model saved.....:', best_tea2_model_file)
+
+    if model_executor is not None:
+        model_executor.shutdown()
 
 
 if __name__ == "__main__":
     # sys.argv[], string
     os.environ['CUDA_VISIBLE_DEVICES'] = sys.argv[1]
     random_seed = int(sys.argv[2])
-    n_gpu = torch.cuda.device_count()
+    use_cuda = True
+    device = torch.device('cuda' if use_cuda and torch.cuda.is_available() else 'cpu')
+    n_gpu = torch.cuda.device_count() if device.type == 'cuda' else 0
+    cpu_threads = min(8, os.cpu_count() or 1)  # intra-op threads for CPU training and decoding
+    cpu_interop_threads = 2
+    if device.type == 'cpu':
+        torch.set_num_threads(cpu_threads)
+        if hasattr(torch, 'set_num_interop_threads'):
+            torch.set_num_interop_threads(cpu_interop_threads)
     set_random_seeds(random_seed)
 
     src_data_folder = sys.argv[3]
@@ -1309,15 +2157,28 @@ if __name__ == "__main__":
     enc_type = ['LSTM', 'GCN', 'LSTM-GCN'][0]
     att_type = ['None', 'Unigram', 'N-Gram-Enc'][1]
     copy_on = True
+    beam_size = 1  # > 1 decodes with beam search instead of greedy search
+    beam_len_penalty = 1.0
+    beam_max_tuples = 0  # > 0 limits the number of tuples in a beam hypothesis
+    decode_shrink_batch = False  # drops finished sequences from the greedy decoding batch
+    script_decoder = False  # TorchScript training recurrence, Unigram attention only, float32 training only
+    train_dtype = 'float32'  # 'float16' trains under autocast with a GradScaler, 'bfloat16' under autocast only
+    predict_dtype = 'float32'  # 'float16' or 'bfloat16' decodes under autocast
+    candidate_softmax = False  # restricts the training softmax to the target ids the batch can produce
+    restricted_decode = False  # projects decoder states only onto the allowed ids of each sentence, needs copy_on
     word_min_freq = 2
     conv_filter_size = 3
     max_word_len = 10
     drop_rate = 0.5  # 0.3
     layers = 2
     gcn_num_layers = 3
+    adj_max_dist = 5
+    sparse_gcn = False  # edge-list GCN instead of dense [batch, n, n] adjacency, single GPU or CPU only
+    pack_encoder = False  # runs the encoder LSTM on packed sequences, padding no longer reaches the backward direction
     word_embed_dim = 300
     char_embed_dim = 50
     char_feature_size = 50
+    cache_char_features = False  # reuse the char-CNN feature of each word across prediction batches
 
     enc_inp_size = word_embed_dim + char_feature_size
     enc_hidden_size = word_embed_dim
@@ -1326,15 +2187,33 @@ if __name__ == "__main__":
 
     early_stop_cnt = 10  
     sample_cnt = 0
-    Sample = recordclass("Sample", "Id SrcLen SrcWords TrgLen TrgWords RelWords EntityWords AdjMat")
+    Sample = recordclass("Sample", "Id SrcLen SrcWords TrgLen TrgWords RelWords EntityWords AdjEdges "
+                                   "SrcIds EntityIds RelIds TrgIds SrcCharIds EntityCharIds RelCharIds")
     embedding_file = os.path.join(src_data_folder, 'w2v.txt')
     rel_file = os.path.join(src_data_folder, 'relations.txt')
     relations = get_relations(rel_file)
     rel_lines = open(rel_file).readlines()
 
+    use_data_cache = True
+    data_cache_version = 3
+    data_cache_folder = os.path.join(src_data_folder, 'cache')
+    embed_cache_version = 2
+    num_workers = os.cpu_count() or 1
+    preprocess_shard_size = 2000
+    prefetch_workers = 2
+    prefetch_depth = 2
+    concurrent_models = False  # overlaps the stu, tea1 and tea2 forward passes, dropout masks become non-deterministic
+    max_batch_tokens = 0  # > 0 packs training batches by padded token count instead of batch_size
+    stream_data = False
+    stream_buffer_size = 100 * batch_size
+
     arg_w_tea1 = 0.6
     arg_w_tea2 = 0.7
     seq2tup_epoch = 10
+    # "stu_cached" trains the student against targets of the saved teachers, computed once over the training set
+    teacher_cache_folder = os.path.join(trg_data_folder, 'teacher_cache')
+    teacher_cache_version = 1
+    teacher_cache_topk = 0  # > 0 also caches the teachers' top-k log-probs as soft targets
 
     # train a model
     if job_mode == 'train':
@@ -1349,23 +2228,30 @@ if __name__ == "__main__":
         src_train_file = os.path.join(src_data_folder, 'train.sent')
         adj_train_file = os.path.join(src_data_folder, 'train.dep')
         trg_train_file = os.path.join(src_data_folder, 'train.tup')
-        train_data = read_data(src_train_file, trg_train_file, adj_train_file, 1)
+        if stream_data:
+            train_data = StreamData(src_train_file, trg_train_file, adj_train_file, 1)
+        else:
+            train_data = read_data(src_train_file, trg_train_file, adj_train_file, 1)
 
         src_dev_file = os.path.join(src_data_folder, 'dev.sent')
         adj_dev_file = os.path.join(src_data_folder, 'dev.dep')
         trg_dev_file = os.path.join(src_data_folder, 'dev.tup')
         dev_data = read_data(src_dev_file, trg_dev_file, adj_dev_file, 2)
 
-        custom_print('Training data size:', len(train_data))
+        if not stream_data:
+            custom_print('Training data size:', len(train_data))
         custom_print('Development data size:', len(dev_data))
 
         custom_print("preparing vocabulary......")
         save_vocab = os.path.join(trg_data_folder, 'vocab.pkl')
 
-        word_vocab, rev_word_vocab, char_vocab, word_embed_matrix = build_vocab(train_data, relations, save_vocab,
+        vocab_data = StreamData(src_train_file, trg_train_file, None, 1) if stream_data else train_data
+        word_vocab, rev_word_vocab, char_vocab, word_embed_matrix = build_vocab(vocab_data, relations, save_vocab,
                                                                                 embedding_file)
+        char_table = CharTable(word_vocab)
+        vocab_const_ids = get_vocab_const_ids()
         custom_print("Training started......")
-        tea_ts_mode = "ts"  # "tea"、"teach_stu"、"ts"
+        tea_ts_mode = "ts"  # "tea"、"teach_stu"、"ts"、"stu_cached"
         train_model(model_name, train_data, dev_data, stu_model_file_name, tea1_model_file_name, tea2_model_file_name, tea_ts_mode)
 
         logger.close()
@@ -1382,6 +2268,8 @@ if __name__ == "__main__":
             idx = word_vocab[word]
             rev_word_vocab[idx] = word
 
+        char_table = CharTable(word_vocab)
+        vocab_const_ids = get_vocab_const_ids()
         word_embed_matrix = np.zeros((len(word_vocab), word_embed_dim), dtype=np.float32)
         custom_print('vocab size:', len(word_vocab))
 
@@ -1403,17 +2291,16 @@ if __name__ == "__main__":
         tea2_model_file = os.path.join(trg_data_folder, 'tea2_model.h5py')
 
         best_stu_model, best_tea1_model, best_tea2_model = get_model(model_name)
-        if torch.cuda.is_available():
-            best_stu_model.cuda()
-            best_tea1_model.cuda()
-            best_tea2_model.cuda()
+        best_stu_model.to(device)
+        best_tea1_model.to(device)
+        best_tea2_model.to(device)
         if n_gpu > 1:
             best_stu_model = torch.nn.DataParallel(best_stu_model)
             best_tea1_model = torch.nn.DataParallel(best_tea1_model)
             best_tea2_model = torch.nn.DataParallel(best_tea2_model)
-        best_stu_model.load_state_dict(torch.load(stu_model_file))
-        best_tea1_model.load_state_dict(torch.load(tea1_model_file))
-        best_tea2_model.load_state_dict(torch.load(tea2_model_file))
+        load_model_state(best_stu_model, stu_model_file)
+        load_model_state(best_tea1_model, tea1_model_file)
+        load_model_state(best_tea2_model, tea2_model_file)
 
         custom_print('Test Results  Copy On, dir在', trg_data_folder)
         set_random_seeds(random_seed)